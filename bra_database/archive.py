@@ -0,0 +1,247 @@
+"""Content-addressed archive storing the BRA PDF files once, compressed into pack files.
+"""
+import argparse
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import sqlite3
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterator, List
+
+from bra_database.utils import get_logger
+
+
+class BraArchive():
+    """Store PDF files by content hash in compressed pack files, with an index from their original link to the blob.
+    A bulletin downloaded on several days is only stored once. Several processes can share an archive, its writes
+    being serialized by a lock file.
+    """
+
+    def __init__(self, archive_path: str, max_pack_size: int = 64 * 1024 * 1024, logger: logging.Logger = None):
+        """Initialize the class, creating the archive if needed.
+        """
+        self.logger = logger or get_logger()
+        self.archive_path = archive_path
+        self.max_pack_size = max_pack_size
+        self.packs_path = os.path.join(self.archive_path, "packs")
+        if not os.path.exists(self.packs_path):
+            os.makedirs(self.packs_path)
+        # Index of the blobs (where to find them in the packs) and of the links pointing to them
+        self.index = sqlite3.connect(os.path.join(self.archive_path, "index.sqlite"))
+        self.index.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                digest TEXT PRIMARY KEY, pack INTEGER, offset INTEGER, length INTEGER, size INTEGER);
+            CREATE TABLE IF NOT EXISTS links (
+                original_link TEXT PRIMARY KEY, digest TEXT, added TEXT);
+        """)
+        self.index.commit()
+        # Memory maps of the packs, opened when read, with the inode of their file
+        self.maps: Dict[int, mmap.mmap] = {}
+        self.inodes: Dict[int, int] = {}
+        # Lock held while writing in the packs
+        self.lock_file = open(os.path.join(self.archive_path, "lock"), "a", encoding="utf8")    # pylint: disable=R1732
+
+    def __enter__(self) -> Any:
+        """Use the archive as a context manager.
+        """
+        return self
+
+    def __exit__(self, *exec_info) -> None:
+        """Close the memory maps and the index.
+        """
+        self.close()
+
+    def close(self) -> None:
+        """Close the memory maps and the index.
+        """
+        for memory_map in self.maps.values():
+            memory_map.close()
+        self.maps = {}
+        self.index.close()
+        self.lock_file.close()
+
+    @contextmanager
+    def _lock(self) -> Iterator[None]:
+        """Hold the write lock of the archive, blocking until the other processes release it.
+        """
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _get_pack_path(self, pack: int) -> str:
+        """Path of a pack file.
+        """
+        return os.path.join(self.packs_path, f"{pack:06d}.pack")
+
+    def _list_packs(self) -> List[int]:
+        """List the existing pack numbers.
+        """
+        return sorted(int(pack.split(".")[0]) for pack in os.listdir(self.packs_path) if pack.endswith(".pack"))
+
+    def _get_writable_pack(self) -> int:
+        """Get the last pack, or a new one if it is full.
+        """
+        packs = self._list_packs()
+        if not packs:
+            return 0
+        if os.path.getsize(self._get_pack_path(packs[-1])) >= self.max_pack_size:
+            return packs[-1] + 1
+        return packs[-1]
+
+    def _append_to_pack(self, pack: int, compressed: bytes) -> int:
+        """Append a compressed blob at the end of a pack and return its offset.
+        """
+        # The memory map would not see the new bytes
+        if pack in self.maps:
+            self.maps.pop(pack).close()
+        with open(self._get_pack_path(pack), "ab") as pack_file:
+            offset = pack_file.tell()
+            pack_file.write(compressed)
+            pack_file.flush()
+            os.fsync(pack_file.fileno())
+        return offset
+
+    def _get_map(self, pack: int, end: int = 0) -> mmap.mmap:
+        """Get the read-only memory map of a pack, covering at least end bytes.
+        It is opened again if another process appended to the pack, or rewrote it during a garbage collection.
+        """
+        pack_path = self._get_pack_path(pack)
+        if pack in self.maps and (len(self.maps[pack]) < end or self.inodes[pack] != os.stat(pack_path).st_ino):
+            self.maps.pop(pack).close()
+        if pack not in self.maps:
+            with open(pack_path, "rb") as pack_file:
+                self.maps[pack] = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.inodes[pack] = os.fstat(pack_file.fileno()).st_ino
+        return self.maps[pack]
+
+    def contains(self, original_link: str) -> bool:
+        """Check if a link is already archived.
+        """
+        cursor = self.index.execute("SELECT 1 FROM links WHERE original_link = ?", (original_link, ))
+        return cursor.fetchone() is not None
+
+    def list_links(self) -> List[str]:
+        """List the archived links.
+        """
+        return [row[0] for row in self.index.execute("SELECT original_link FROM links ORDER BY original_link")]
+
+    def put(self, original_link: str, data: bytes) -> str:
+        """Archive the content of a file, only storing it if this content is not already known.
+
+        returns:
+            str: The content hash of the file.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        compressed = zlib.compress(data)
+        with self._lock():
+            known = self.index.execute("SELECT 1 FROM blobs WHERE digest = ?", (digest, )).fetchone()
+            if not known:
+                pack = self._get_writable_pack()
+                offset = self._append_to_pack(pack, compressed)
+                self.index.execute("INSERT INTO blobs (digest, pack, offset, length, size) VALUES (?, ?, ?, ?, ?)",
+                                   (digest, pack, offset, len(compressed), len(data)))
+                self.logger.debug(f"Archived {original_link} ({len(data)} -> {len(compressed)} bytes)")
+            else:
+                self.logger.debug(f"Content of {original_link} already archived")
+            self.index.execute("INSERT OR REPLACE INTO links (original_link, digest, added) VALUES (?, ?, ?)",
+                               (original_link, digest, datetime.today().strftime("%Y%m%d")))
+            self.index.commit()
+        return digest
+
+    def read(self, original_link: str) -> bytes:
+        """Read the content of an archived file, decompressed straight from the memory mapped pack.
+        """
+        row = self.index.execute(
+            """
+            SELECT blobs.pack, blobs.offset, blobs.length FROM links
+            JOIN blobs ON blobs.digest = links.digest
+            WHERE links.original_link = ?
+            """, (original_link, )).fetchone()
+        if row is None:
+            raise KeyError(f"{original_link} is not archived")
+        pack, offset, length = row
+        with memoryview(self._get_map(pack, offset + length)) as view:
+            return zlib.decompress(view[offset:offset + length])
+
+    def remove(self, original_link: str) -> None:
+        """Remove a link from the index, its blob being dropped by the next garbage collection.
+        """
+        self.index.execute("DELETE FROM links WHERE original_link = ?", (original_link, ))
+        self.index.commit()
+
+    def remove_older_than(self, days: int) -> int:
+        """Remove the links added more than some days ago.
+
+        returns:
+            int: The number of removed links.
+        """
+        limit = (datetime.today() - timedelta(days=days)).strftime("%Y%m%d")
+        cursor = self.index.execute("DELETE FROM links WHERE added < ?", (limit, ))
+        self.index.commit()
+        return cursor.rowcount
+
+    def gc(self) -> int:
+        """Drop the blobs no longer referenced by any link, and rewrite the packs containing them.
+
+        returns:
+            int: The number of bytes freed on disk.
+        """
+        with self._lock():
+            self.index.execute("DELETE FROM blobs WHERE digest NOT IN (SELECT digest FROM links)")
+            self.index.commit()
+            freed = 0
+            new_pack = None
+            for pack in self._list_packs():
+                pack_path = self._get_pack_path(pack)
+                pack_size = os.path.getsize(pack_path)
+                blobs = self.index.execute("SELECT digest, offset, length FROM blobs WHERE pack = ? ORDER BY offset",
+                                           (pack, )).fetchall()
+                live_size = sum(length for _, _, length in blobs)
+                if live_size == pack_size:
+                    continue
+                # Live blobs are copied in a new pack before the old one is deleted, so the index is never invalid
+                if new_pack is None:
+                    new_pack = self._list_packs()[-1] + 1
+                if blobs:
+                    with memoryview(self._get_map(pack, pack_size)) as view:
+                        for digest, offset, length in blobs:
+                            new_offset = self._append_to_pack(new_pack, view[offset:offset + length])
+                            self.index.execute("UPDATE blobs SET pack = ?, offset = ? WHERE digest = ?",
+                                               (new_pack, new_offset, digest))
+                    self.index.commit()
+                if pack in self.maps:
+                    self.maps.pop(pack).close()
+                os.remove(pack_path)
+                freed += pack_size - live_size
+        self.logger.info(f"Archive garbage collection freed {freed} bytes")
+        return freed
+
+
+def main() -> None:
+    """Manage an archive from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Manage the BRA PDF archive.")
+    parser.add_argument("command", choices=["gc", "list"], help="gc: drop the unreferenced blobs, list: list links")
+    parser.add_argument("--path",
+                        default=os.environ.get("BRA_ARCHIVE_FOLDER", os.path.join(os.sep, "archive")),
+                        help="Folder of the archive, BRA_ARCHIVE_FOLDER by default")
+    parser.add_argument("--older-than", type=int, default=None, help="Before a gc, remove links older than N days")
+    args = parser.parse_args()
+    with BraArchive(args.path) as archive:
+        if args.command == "gc":
+            if args.older_than is not None:
+                archive.logger.info(f"Removed {archive.remove_older_than(args.older_than)} links")
+            archive.gc()
+        else:
+            for link in archive.list_links():
+                print(link)
+
+
+if __name__ == "__main__":
+    main()
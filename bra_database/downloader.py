@@ -2,32 +2,88 @@
 """
 import logging
 import os
-import shutil
+from dataclasses import dataclass, field
 from datetime import datetime
+from typing import List, Optional, Set, Tuple
 
 import requests
-from retry import retry
 
-from bra_database.utils import get_logger
+from bra_database.archive import BraArchive
+from bra_database.utils import RetryPolicy, get_logger, is_retryable_http_error
+
+# Where the BRA are published, also used as their original link
+METEO_FRANCE_URL = "https://donneespubliques.meteofrance.fr/donnees_libres/Pdf/BRA"
+
+
+def get_original_link(file_name: str) -> str:
+    """Link of a BRA file on Météo-France, used to identify it in the database.
+    """
+    return f"{METEO_FRANCE_URL}/BRA.{file_name}"
+
+
+@dataclass
+class WorkPlan:
+    """BRA files of a day still to be processed, the ones already in the database being left out.
+    """
+    listed: int = 0
+    """
+    Number of files in the JSON file of the day.
+    """
+    inserted: int = 0
+    """
+    Number of these files already in the database.
+    """
+    items: List[Tuple[str, str]] = field(default_factory=list)
+    """
+    (massif, heure) of the files to be processed.
+    """
+    cached: Set[str] = field(default_factory=set)
+    """
+    Names of the files to be processed that are already downloaded.
+    """
+
+    def report(self) -> str:
+        """Summary of the plan, and the files to be processed.
+        """
+        lines = [
+            f"{self.listed} BRA listed, {self.inserted} already in the database, {len(self.items)} to process "
+            f"({len(self.items) - len(self.cached)} to download)."
+        ]
+        for massif, time in self.items:
+            file_name = f"{massif}.{time}.pdf"
+            lines.append(f"\t- {file_name}{' (downloaded)' if file_name in self.cached else ''}")
+        return "\n".join(lines)
 
 
 class BraDownloader():
     """Download PDF files.
     """
 
-    def __init__(self, pdf_path: str, logger: logging.Logger = None):
+    def __init__(self,
+                 pdf_path: str,
+                 logger: logging.Logger = None,
+                 archive: BraArchive = None,
+                 base_url: str = METEO_FRANCE_URL,
+                 retry_policy: RetryPolicy = None):
         """Initialize the class.
+        If an archive is given, the files are stored in it rather than in the PDF folder.
         """
         self.logger = logger or get_logger()
         self.pdf_path = pdf_path
+        self.archive = archive
+        self.base_url = base_url
+        self.retry_policy = retry_policy or RetryPolicy(
+            "Météo-France", is_retryable=is_retryable_http_error, logger=self.logger)
         self.file_name = []
 
-        if not os.path.exists(self.pdf_path):
-            os.makedirs(self.pdf_path)
-        self.logger.info(f"Downloading data in folder: {self.pdf_path}")
+        if self.archive:
+            self.logger.info(f"Downloading data in archive: {self.archive.archive_path}")
+        else:
+            if not os.path.exists(self.pdf_path):
+                os.makedirs(self.pdf_path)
+            self.logger.info(f"Downloading data in folder: {self.pdf_path}")
 
-    @staticmethod
-    def _create_file_path(date: str = None) -> str:
+    def _create_file_path(self, date: str = None) -> str:
         """Concatenate the date of today with the expected JSON URL.
 
         returns:
@@ -35,35 +91,101 @@ class BraDownloader():
         """
         if not date:
             date = datetime.today().strftime("%Y%m%d")
-        file_path = f"https://donneespubliques.meteofrance.fr/donnees_libres/Pdf/BRA/bra.{date}.json"
+        file_path = f"{self.base_url}/bra.{date}.json"
         return file_path
 
+    def _get(self, url: str, stream: bool = False) -> requests.Response:
+        """GET an URL, raising on HTTP errors.
+        """
+        response = requests.get(url, stream=stream, timeout=60)
+        response.raise_for_status()
+        return response
+
     def get_json_timestamp_file(self, date: str = None) -> None:
         """A JSON file contains the timestamps of the files to be downloaded.
         """
         json_file_path = self._create_file_path(date=date)
         self.logger.info(f"Downloading JSON file listing BRA: {json_file_path}")
-        self.timestamps_bra = requests.get(json_file_path).json()
+        self.timestamps_bra = self.retry_policy.call(lambda: self._get(json_file_path).json())
         self.logger.info(f"{len(self.timestamps_bra)} BRA file to be downloaded.")
 
-    @retry(tries=2, delay=10)
     def _download_file(self, file_name: str) -> None:
         """Download a BRA file.
         """
+        bra_url = f"{self.base_url}/BRA.{file_name}"
+        original_link = get_original_link(file_name)
+        if self.archive:
+            if not self.archive.contains(original_link):
+                self.logger.debug(f"Téléchargement de {bra_url}")
+                response = self._get(bra_url)
+                self.archive.put(original_link, response.content)
+            return
         file_path = os.path.join(self.pdf_path, file_name)
         if not os.path.isfile(file_path):
-            bra_url = f"https://donneespubliques.meteofrance.fr/donnees_libres/Pdf/BRA/BRA.{file_name}"
             self.logger.debug(f"Téléchargement de {bra_url}")
-            response = requests.get(bra_url, stream=True)
-            with open(file_path, 'wb') as out_file:
-                shutil.copyfileobj(response.raw, out_file)
+            response = self._get(bra_url, stream=True)
+            # A download failing midway does not leave a truncated file, and raises a retryable requests error
+            try:
+                with open(f"{file_path}.part", 'wb') as out_file:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        out_file.write(chunk)
+            except Exception:
+                os.remove(f"{file_path}.part")
+                raise
+            os.replace(f"{file_path}.part", file_path)
+
+    def _is_downloaded(self, file_name: str) -> bool:
+        """Check if a file is already in the archive or in the PDF folder.
+        """
+        if self.archive:
+            return self.archive.contains(get_original_link(file_name))
+        return os.path.isfile(os.path.join(self.pdf_path, file_name))
+
+    def list_original_links(self) -> List[str]:
+        """Original links of the files listed in the JSON file.
+        """
+        return [
+            get_original_link(f"{bra['massif']}.{time}.pdf") for bra in self.timestamps_bra for time in bra['heures']
+        ]
 
-    def get_pdf_files(self) -> None:
-        """Download a PDF file.
+    def plan(self, inserted_links: Set[str]) -> WorkPlan:
+        """Plan the work of the day: only the files of the JSON file that are not in the database are kept.
         """
+        work_plan = WorkPlan()
         for bra in self.timestamps_bra:
             for time in bra['heures']:
                 file_name = f"{bra['massif']}.{time}.pdf"
-                self.file_name.append(file_name)
-                if file_name not in os.listdir(self.pdf_path):
-                    self._download_file(file_name=file_name)
+                work_plan.listed += 1
+                if get_original_link(file_name) in inserted_links:
+                    work_plan.inserted += 1
+                    continue
+                work_plan.items.append((bra['massif'], time))
+                if self._is_downloaded(file_name):
+                    work_plan.cached.add(file_name)
+        return work_plan
+
+    def get_pdf_file(self, massif: str, time: str) -> Optional[str]:
+        """Download the PDF file of a massif at a given time.
+        A file that can not be downloaded (such as a 404) is skipped, other errors are raised once retries are over.
+
+        returns:
+            Optional[str]: The name of the file, None if skipped.
+        """
+        file_name = f"{massif}.{time}.pdf"
+        try:
+            self.retry_policy.call(lambda: self._download_file(file_name=file_name))
+        except requests.HTTPError as error:
+            if is_retryable_http_error(error):
+                raise
+            self.logger.error(f"Skipping {file_name}: {error}")
+            return None
+        self.file_name.append(file_name)
+        return file_name
+
+    def get_pdf_files(self, items: List[Tuple[str, str]] = None) -> None:
+        """Download the PDF files of some (massif, heure) items, all the ones of the JSON file by default.
+        """
+        if items is None:
+            items = [(bra['massif'], time) for bra in self.timestamps_bra for time in bra['heures']]
+        for massif, time in items:
+            self.get_pdf_file(massif, time)
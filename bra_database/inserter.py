@@ -1,28 +1,55 @@
 """Insert structured data into a GCP MySQL database.
 """
+import argparse
 import logging
-from typing import Any, List, get_type_hints
+import queue
+import threading
+import time
+from datetime import datetime
+from typing import Any, List, Optional, Set, Tuple, get_type_hints
 
 import pymysql
 from pymysql.err import IntegrityError
 
 from bra_database.parser import StructuredData
-from bra_database.utils import DbCredentials, get_logger
+from bra_database.utils import DbCredentials, RetryPolicy, get_logger
 
 
 class BraInserter():
     """Insert structured data into an SQL database.
     """
 
-    def __init__(self, credentials: DbCredentials, logger: logging.Logger = None) -> None:
+    def __init__(self,
+                 credentials: DbCredentials,
+                 logger: logging.Logger = None,
+                 asynchronous: bool = False,
+                 batch_size: int = 20,
+                 flush_interval: float = 5.0,
+                 queue_size: int = 100,
+                 retry_policy: RetryPolicy = None) -> None:
+        """Initialise the database and the table.
+        In asynchronous mode, the rows are inserted by batches from a background thread, flushed every batch_size
+        rows or flush_interval seconds. At most queue_size rows are waiting, insert() blocking beyond.
+        """
         self.credentials = credentials
         # Logger
         self.logger = logger or get_logger()
+        self.retry_policy = retry_policy or self.credentials.retry_policy
+        # Background writer
+        self.asynchronous = asynchronous
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.queue_size = queue_size
+        self.writer: Optional[threading.Thread] = None
+        self.writer_error: Optional[Exception] = None
+        self.writer_connection: Optional[pymysql.connections.Connection] = None
+        # Narrow table of the latest risk per massif and day, maintained along the main one
+        self.summary_table = f"{self.credentials.database}.{self.credentials.table}_daily"
         # Connection
-        connection = pymysql.connect(host=self.credentials.host,
-                                     user=self.credentials.user,
-                                     password=self.credentials.password,
-                                     port=self.credentials.port)
+        connection = self.retry_policy.call(lambda: pymysql.connect(host=self.credentials.host,
+                                                                    user=self.credentials.user,
+                                                                    password=self.credentials.password,
+                                                                    port=self.credentials.port))
         # Database
         with connection.cursor() as cursor:
             cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.credentials.database}")
@@ -36,12 +63,13 @@ class BraInserter():
         query = self._get_create_query_bra_table()
         with connection.cursor() as cursor:
             cursor.execute(query)
+            cursor.execute(self._get_create_query_summary_table())
         connection.commit()
         connection.close()
         # Inserted files
-        self.__enter__()
+        self.connection = self.retry_policy.call(self._connect)
         self.inserted_files = self.list_inserted_files_recently()
-        self.__exit__()
+        self.connection.close()
 
     def _get_create_query_bra_table(self) -> str:
         """Use the type hints from the StructuredData object to create a table.
@@ -74,21 +102,61 @@ class BraInserter():
         """
         return query
 
+    def _get_create_query_summary_table(self) -> str:
+        """Query creating the table of the latest risk per massif and day.
+        """
+        return f"""
+            CREATE TABLE IF NOT EXISTS {self.summary_table} \
+            (massif VARCHAR(150), date DATE, risk_score SMALLINT, until DATETIME, original_link VARCHAR(150), \
+            PRIMARY KEY (massif, date)) \
+            DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """
+
+    def _connect(self) -> pymysql.connections.Connection:
+        """Get a connection to the database.
+        """
+        return pymysql.connect(host=self.credentials.host,
+                               user=self.credentials.user,
+                               password=self.credentials.password,
+                               port=self.credentials.port,
+                               db=self.credentials.database)
+
     def __enter__(self) -> Any:
-        """Get a connection.
+        """Get a connection, and start the background writer in asynchronous mode.
         """
-        self.connection = pymysql.connect(host=self.credentials.host,
-                                          user=self.credentials.user,
-                                          password=self.credentials.password,
-                                          port=self.credentials.port,
-                                          db=self.credentials.database)
+        self.connection = self.retry_policy.call(self._connect)
+        if self.asynchronous:
+            self.writer_error = None
+            self.rows: queue.Queue = queue.Queue(maxsize=self.queue_size)
+            self.writer = threading.Thread(target=self._write_rows, name="bra-inserter-writer", daemon=True)
+            self.writer.start()
         return self
 
     def __exit__(self, *exec_info) -> None:
-        """Clear the connection
+        """Wait for the background writer to drain its queue, and clear the connection.
+        The error of the writer is raised, unless another one is already raised in the with block.
         """
+        if self.writer:
+            # None tells the writer that no more rows will come
+            self.rows.put(None)
+            self.writer.join()
+            self.writer = None
+        if self.writer_connection:
+            self.writer_connection.close()
+            self.writer_connection = None
         self.connection.commit()
         self.connection.close()
+        if exec_info[0] is not None and self.writer_error:
+            self.logger.error(f"Background writer error hidden by {exec_info[0].__name__}: {self.writer_error}")
+            return
+        self._raise_writer_error()
+
+    def _raise_writer_error(self) -> None:
+        """Raise in the caller thread the error met by the background writer.
+        The error is kept until the end of the with block, the writer dropping all the rows after it.
+        """
+        if self.writer_error:
+            raise self.writer_error
 
     def list_inserted_files_recently(self, days: int = 7) -> List[str]:
         """List the original PDF file from the database that have been inserted less than a week ago.
@@ -100,41 +168,238 @@ class BraInserter():
         """
         return [file["original_link"] for file in self.exec_query(query, output=True)]
 
+    def list_inserted_links(self, original_links: List[str], chunk_size: int = 500) -> Set[str]:
+        """Among some original PDF links, find the ones already in the database, whatever their date.
+        """
+        inserted = set()
+        for index in range(0, len(original_links), chunk_size):
+            chunk = original_links[index:index + chunk_size]
+            query = f"""
+                SELECT DISTINCT original_link
+                FROM {self.credentials.database}.{self.credentials.table}
+                WHERE original_link IN ({', '.join(['%s' for _ in chunk])})
+            """
+            inserted.update(file["original_link"] for file in self.exec_query(query, tuple(chunk), output=True))
+        return inserted
+
     def get_cursor(self) -> pymysql.cursors.DictCursor:
         """Get a cursor.
         """
         return self.connection.cursor(pymysql.cursors.DictCursor)
 
+    def _get_insert_query(self) -> str:
+        """Query inserting a row in the table.
+        """
+        return f"""
+            INSERT INTO {self.credentials.database}.{self.credentials.table} \
+            ({', '.join(self.table_columns)}) VALUES \
+            ({', '.join(['%s' for _ in self.table_columns])})
+        """
+
+    def _get_summary_query(self) -> str:
+        """Query upserting the risk of a massif for a day, only replacing it with a more recent bulletin.
+        The links of a massif only differ by their publication timestamp, so the latest one is the greatest.
+        """
+        latest = "VALUES(original_link) >= original_link"
+        return f"""
+            INSERT INTO {self.summary_table} (massif, date, risk_score, until, original_link) \
+            VALUES (%s, %s, %s, %s, %s) \
+            ON DUPLICATE KEY UPDATE \
+            risk_score = IF({latest}, VALUES(risk_score), risk_score), \
+            until = IF({latest}, VALUES(until), until), \
+            original_link = IF({latest}, VALUES(original_link), original_link)
+        """
+
+    def _get_summary_row(self, row: Tuple[Any, ...]) -> Optional[Tuple[Any, ...]]:
+        """Values of the summary table from a row of the main table, if it has a massif, a parsed date and a risk.
+        A bulletin whose risk could not be read does not replace the risk of an older one.
+        """
+        values = dict(zip(self.table_columns, row))
+        if values["massif"] is None or not isinstance(values["date"], datetime) or values["risk_score"] is None:
+            return None
+        # Plain placeholders only, for pymysql to send the rows in a single multi-row INSERT
+        values["date"] = values["date"].date()
+        return tuple(values[column] for column in ["massif", "date", "risk_score", "until", "original_link"])
+
+    def _get_row(self, structured_data: StructuredData) -> Tuple[Any, ...]:
+        """Values of a structured data, in the order of the table columns.
+        """
+        data = ()
+        for columns in self.table_columns:
+            data += (getattr(structured_data, columns), )
+        return data
+
     def insert(self, structured_data: StructuredData) -> None:
         """Insert a structured data extracted from PDF BRA.
+        In asynchronous mode, the row is only queued for the background writer.
         """
         if structured_data.original_link not in self.inserted_files:
-            data = ()
-            for columns in self.table_columns:
-                data += (getattr(structured_data, columns), )
-            query = f"""
-                INSERT INTO {self.credentials.database}.{self.credentials.table} \
-                ({', '.join(self.table_columns)}) VALUES \
-                ({', '.join(['%s' for _ in self.table_columns])})
-            """
-            self.exec_query(query, data)
+            if self.writer:
+                self._raise_writer_error()
+                self.rows.put(self._get_row(structured_data))
+            else:
+                self._insert_batch([self._get_row(structured_data)])
         else:
             self.logger.info(f"Tried to insert already treated file {structured_data.original_link}")
 
-    def exec_query(self, query: str, data: Any = None, output: bool = False) -> Any:
-        """Execute a query.
+    def flush(self) -> None:
+        """Wait for the background writer to write all the queued rows, and raise its error if any.
+        """
+        if self.writer:
+            # An empty row makes the writer insert its current batch without waiting
+            self.rows.put(())
+            self.rows.join()
+        self._raise_writer_error()
+
+    def _write_rows(self) -> None:
+        """Background writer: insert the queued rows by batches, until None is received.
+        After an error, rows are still consumed so that insert() never blocks, but dropped.
         """
-        self.logger.info(f"Executing {query.split()[0]} query on {self.credentials.database}.{self.credentials.table}")
-        with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
+        self.writer_connection = None
+        batch: List[Tuple[Any, ...]] = []
+        deadline = None
+        received = 0
+        while True:
             try:
+                timeout = max(deadline - time.monotonic(), 0) if deadline else None
+                row = self.rows.get(timeout=timeout)
+                received += 1
+            except queue.Empty:
+                row = ()
+            if row:
+                batch.append(row)
+                deadline = deadline or time.monotonic() + self.flush_interval
+            if batch and (not row or len(batch) >= self.batch_size):
+                if not self.writer_error:
+                    try:
+                        self._insert_batch(batch)
+                    except Exception as error:    # pylint: disable=W0703
+                        self.logger.error(f"Background writer failed, dropping the next rows: {error}")
+                        self.writer_error = error
+                batch, deadline = [], None
+            # Rows are only done once written
+            if not batch:
+                for _ in range(received):
+                    self.rows.task_done()
+                received = 0
+            if row is None:
+                break
+        if self.writer_connection:
+            self.writer_connection.close()
+            self.writer_connection = None
+
+    def _insert_batch(self, batch: List[Tuple[Any, ...]]) -> None:
+        """Insert a batch of rows in a single round-trip, falling back row by row if one of them is a duplicate.
+        The summary table is upserted from the inserted rows in the same transaction.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"Executing INSERT query of {len(batch)} rows on "
+                              f"{self.credentials.database}.{self.credentials.table}")
+        query = self._get_insert_query()
+        summary_query = self._get_summary_query()
+
+        def insert() -> None:
+            if not self.writer_connection or not self.writer_connection.open:
+                self.writer_connection = self._connect()
+            with self.writer_connection.cursor() as cursor:
+                inserted = batch
+                try:
+                    cursor.executemany(query, batch)
+                except IntegrityError:
+                    self.writer_connection.rollback()
+                    inserted = []
+                    for row in batch:
+                        try:
+                            cursor.execute(query, row)
+                            inserted.append(row)
+                        except IntegrityError as error:
+                            self.logger.error(str(error))
+                summaries = [summary for summary in map(self._get_summary_row, inserted) if summary]
+                if summaries:
+                    cursor.executemany(summary_query, summaries)
+                self.writer_connection.commit()
+
+        self.retry_policy.call(insert)
+
+    def rebuild_summary(self) -> int:
+        """Rebuild the summary table from the whole main table, keeping the latest bulletin with a risk of each massif
+        and day, as the incremental upserts do.
+
+        returns:
+            int: The number of rows of the summary table.
+        """
+        self.logger.info(f"Rebuilding {self.summary_table} from {self.credentials.database}.{self.credentials.table}")
+        table = f"{self.credentials.database}.{self.credentials.table}"
+
+        def rebuild(cursor: pymysql.cursors.Cursor) -> int:
+            cursor.execute(f"DELETE FROM {self.summary_table}")
+            cursor.execute(f"""
+                INSERT IGNORE INTO {self.summary_table} (massif, date, risk_score, until, original_link)
+                SELECT bra.massif, DATE(bra.date), bra.risk_score, bra.until, bra.original_link
+                FROM {table} AS bra
+                JOIN (
+                    SELECT massif, DATE(date) AS day, MAX(original_link) AS original_link
+                    FROM {table}
+                    WHERE massif IS NOT NULL AND date IS NOT NULL AND risk_score IS NOT NULL
+                    GROUP BY massif, DATE(date)
+                ) AS latest
+                ON bra.massif = latest.massif AND DATE(bra.date) = latest.day
+                AND bra.original_link = latest.original_link
+            """)
+            return cursor.rowcount
+
+        def execute() -> int:
+            if not self.connection.open:
+                self.connection = self._connect()
+            with self.connection.cursor() as cursor:
+                try:
+                    rows = rebuild(cursor)
+                except Exception:
+                    self.connection.rollback()
+                    raise
+            self.connection.commit()
+            return rows
+
+        rows = self.retry_policy.call(execute)
+        self.logger.info(f"Summary table rebuilt with {rows} rows")
+        return rows
+
+    def exec_query(self, query: str, data: Any = None, output: bool = False) -> Any:
+        """Execute a query, reconnecting and retrying if the connection is lost.
+        """
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                f"Executing {query.split()[0]} query on {self.credentials.database}.{self.credentials.table}")
+
+        def execute() -> Any:
+            if not self.connection.open:
+                self.connection = self._connect()
+            with self.connection.cursor(pymysql.cursors.DictCursor) as cursor:
                 if data:
                     cursor.execute(query, data)
                 else:
                     cursor.execute(query)
-            except IntegrityError as error:
-                self.logger.error(str(error))
+                self.connection.commit()
+                if output:
+                    return cursor.fetchall()
                 return None
-            self.connection.commit()
-            if output:
-                return cursor.fetchall()
+
+        try:
+            return self.retry_policy.call(execute)
+        except IntegrityError as error:
+            self.logger.error(str(error))
             return None
+
+
+def main() -> None:
+    """Manage the summary table from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Manage the table of the latest risk per massif and day.")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: fill the table from the whole BRA table")
+    parser.parse_args()
+    with BraInserter(credentials=DbCredentials()) as inserter:
+        inserter.rebuild_summary()
+
+
+if __name__ == "__main__":
+    main()
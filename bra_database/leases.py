@@ -0,0 +1,183 @@
+"""Split the BRA files of a day between several workers, through leases stored in the database.
+"""
+import logging
+import os
+import socket
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymysql
+
+from bra_database.utils import DbCredentials, RetryPolicy, get_logger
+
+
+class BraWorkQueue():
+    """Work queue of the (massif, heure) items of a day.
+    Each item is claimed by a worker with a lease expiring after some time: the items of a crashed worker are
+    claimed again by the others once their lease is over. Time is the one of the database, not of the workers.
+    """
+
+    def __init__(self,
+                 credentials: DbCredentials,
+                 lease_seconds: int = 600,
+                 owner: str = None,
+                 logger: logging.Logger = None,
+                 retry_policy: RetryPolicy = None) -> None:
+        self.credentials = credentials
+        self.retry_policy = retry_policy or self.credentials.retry_policy
+        self.lease_seconds = lease_seconds
+        self.owner = owner or f"{socket.gethostname()}-{os.getpid()}"
+        # Logger
+        self.logger = logger or get_logger()
+        self.table = f"{self.credentials.database}.{self.credentials.table}_leases"
+        # Leases tokens of the items claimed by this worker
+        self.tokens: Dict[Tuple[str, str], str] = {}
+        # Database
+        connection = self.retry_policy.call(lambda: pymysql.connect(host=self.credentials.host,
+                                                                    user=self.credentials.user,
+                                                                    password=self.credentials.password,
+                                                                    port=self.credentials.port))
+        with connection.cursor() as cursor:
+            cursor.execute(f"CREATE DATABASE IF NOT EXISTS {self.credentials.database}")
+            cursor.execute(f"""
+                CREATE TABLE IF NOT EXISTS {self.table} \
+                (day VARCHAR(8), massif VARCHAR(150), heure VARCHAR(20), owner VARCHAR(150), token CHAR(32), \
+                expires DATETIME, done BOOLEAN NOT NULL DEFAULT FALSE, \
+                PRIMARY KEY (day, massif, heure), INDEX lease_token (token)) \
+                DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+            """)
+        connection.commit()
+        connection.close()
+
+    def _connect(self) -> pymysql.connections.Connection:
+        """Get a connection to the database.
+        """
+        return pymysql.connect(host=self.credentials.host,
+                               user=self.credentials.user,
+                               password=self.credentials.password,
+                               port=self.credentials.port,
+                               db=self.credentials.database)
+
+    def __enter__(self) -> Any:
+        """Get a connection.
+        """
+        self.connection = self.retry_policy.call(self._connect)
+        return self
+
+    def __exit__(self, *exec_info) -> None:
+        """Clear the connection
+        """
+        self.connection.commit()
+        self.connection.close()
+
+    def _call(self, function: Callable[[pymysql.cursors.Cursor], Any]) -> Any:
+        """Call a function with a cursor and commit, reconnecting and retrying if the connection is lost.
+        """
+
+        def call() -> Any:
+            if not self.connection.open:
+                self.connection = self._connect()
+            with self.connection.cursor() as cursor:
+                result = function(cursor)
+            self.connection.commit()
+            return result
+
+        return self.retry_policy.call(call)
+
+    def enqueue(self, day: str, items: List[Tuple[str, str]]) -> int:
+        """Add (massif, heure) items to the queue of a day, if not already there.
+
+        returns:
+            int: The number of added items.
+        """
+        rows = [(day, massif, time) for massif, time in items]
+        added = self._call(lambda cursor: cursor.executemany(
+            f"INSERT IGNORE INTO {self.table} (day, massif, heure) VALUES (%s, %s, %s)", rows))
+        self.logger.info(f"Added {added} items to the work queue of {day}, out of {len(items)}")
+        return added
+
+    def _claim_one(self, cursor: pymysql.cursors.Cursor, day: str) -> Optional[Tuple[str, str]]:
+        """Claim a single item, its row being locked by the UPDATE so that no other worker gets it.
+        """
+        token = uuid.uuid4().hex
+        cursor.execute(
+            f"""
+            UPDATE {self.table} \
+            SET owner = %s, token = %s, expires = NOW() + INTERVAL %s SECOND \
+            WHERE day = %s AND NOT done AND (owner IS NULL OR expires < NOW()) \
+            ORDER BY massif, heure LIMIT 1
+            """, (self.owner, token, self.lease_seconds, day))
+        if cursor.rowcount == 0:
+            return None
+        cursor.execute(f"SELECT massif, heure FROM {self.table} WHERE token = %s", (token, ))
+        item = cursor.fetchone()
+        self.tokens[item] = token
+        return item
+
+    def claim(self, day: str, size: int = 1) -> List[Tuple[str, str]]:
+        """Claim up to size items of a day, that are not done and free or with an expired lease.
+
+        returns:
+            List[Tuple[str, str]]: The claimed (massif, heure) items.
+        """
+        claimed = []
+        for _ in range(size):
+            item = self._call(lambda cursor: self._claim_one(cursor, day))
+            if item is None:
+                break
+            claimed.append(item)
+        if claimed:
+            self.logger.info(f"Worker {self.owner} claimed {len(claimed)} items of {day}")
+        return claimed
+
+    def renew(self, items: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        """Extend the leases of claimed items, and drop the ones taken over by another worker in the meantime.
+        To be called between the stages of a batch, so that a slow batch keeps its items.
+
+        returns:
+            List[Tuple[str, str]]: The items still held by this worker.
+        """
+        tokens = {self.tokens[item]: item for item in items if item in self.tokens}
+        if not tokens:
+            return []
+
+        def extend(cursor: pymysql.cursors.Cursor) -> List[str]:
+            placeholders = ", ".join(["%s" for _ in tokens])
+            cursor.execute(
+                f"UPDATE {self.table} SET expires = NOW() + INTERVAL %s SECOND "
+                f"WHERE token IN ({placeholders}) AND NOT done", (self.lease_seconds, *tokens))
+            cursor.execute(f"SELECT token FROM {self.table} WHERE token IN ({placeholders})", tuple(tokens))
+            return [row[0] for row in cursor.fetchall()]
+
+        held = set(self._call(extend))
+        lost = [item for token, item in tokens.items() if token not in held]
+        for item in lost:
+            self.tokens.pop(item)
+        if lost:
+            self.logger.error(f"Worker {self.owner} lost the lease of {len(lost)} items, dropping them")
+        return [item for item in items if item in self.tokens]
+
+    def complete(self, items: List[Tuple[str, str]]) -> int:
+        """Mark claimed items as done, if their lease was not taken over by another worker in the meantime.
+
+        returns:
+            int: The number of items marked as done.
+        """
+        if not items:
+            return 0
+        tokens = [(self.tokens.pop(item), ) for item in items]
+        done = self._call(
+            lambda cursor: cursor.executemany(f"UPDATE {self.table} SET done = TRUE WHERE token = %s", tokens))
+        if done != len(items):
+            self.logger.error(f"Worker {self.owner} lost the lease of {len(items) - done} items")
+        return done
+
+    def count_remaining(self, day: str) -> int:
+        """Count the items of a day that are not done yet.
+        """
+
+        def count(cursor: pymysql.cursors.Cursor) -> int:
+            cursor.execute(f"SELECT COUNT(*) FROM {self.table} WHERE day = %s AND NOT done", (day, ))
+            return cursor.fetchone()[0]
+
+        return self._call(count)
@@ -0,0 +1,473 @@
+"""Load test of the whole pipeline, offline: synthetic BRA are served locally and inserted into a DB stand-in.
+"""
+import argparse
+import functools
+import io
+import json
+import os
+import re
+import resource
+import runpy
+import tempfile
+import threading
+import time
+import zlib
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Set, Tuple
+
+import cv2
+import numpy
+import pdfplumber
+import pymysql
+from pymysql.cursors import RE_INSERT_VALUES
+
+from bra_database.downloader import BraDownloader
+from bra_database.inserter import BraInserter
+from bra_database.parser import PdfParser
+from bra_database.utils import get_logger
+
+ROOT_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class SyntheticBraServer():
+    """Serve the bra.{date}.json indexes and the PDF files of synthetic massifs, on a local port.
+    Every PDF is a clone of a sample BRA, with a trailing comment making its content unique. Its risk image is redrawn
+    with a risk from 1 to 5 picked from the file name, so that a day has several distinct images to read by OCR.
+    """
+
+    def __init__(self, sample_pdf: str, massifs: int) -> None:
+        with open(sample_pdf, "rb") as pdf:
+            sample = pdf.read()
+        self.samples = {risk: self._draw_risk(sample, risk) for risk in range(1, 6)}
+        self.massifs = [f"MASSIF{index:02d}" for index in range(massifs)]
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._get_handler())
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def __enter__(self) -> Any:
+        """Start serving in a background thread.
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exec_info) -> None:
+        """Stop serving.
+        """
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get_index(self, date: str) -> List[Dict[str, Any]]:
+        """JSON index of a day, with a single bulletin per massif.
+        """
+        return [{"massif": massif, "heures": [f"{date}150738"]} for massif in self.massifs]
+
+    @staticmethod
+    def _draw_risk(sample: bytes, risk: int) -> bytes:
+        """Sample BRA with another risk drawn on its risk image.
+        The new image is appended as an incremental update of the PDF, replacing the image object of the sample.
+        """
+        with pdfplumber.open(io.BytesIO(sample)) as pdf:
+            image = [img for img in pdf.pages[0].images if img["name"] == "Im10"][0]
+            width, height = image["srcsize"]
+            pixels = numpy.frombuffer(image["stream"].get_data(), numpy.uint8).reshape(height, width, 3).copy()
+            object_id = image["stream"].objid
+            trailer = pdf.doc.xrefs[0].trailer
+        # Blank the digit of the sample in the top left corner, and draw the new one instead
+        pixels[0:16, 0:14] = 255
+        font = cv2.FONT_HERSHEY_SIMPLEX    # pylint: disable=E1101
+        cv2.putText(pixels, str(risk), (2, 14), font, 0.5, (0, 0, 0), 2, cv2.LINE_AA)    # pylint: disable=E1101
+        data = zlib.compress(pixels.tobytes())
+        image_object = (f"{object_id} 0 obj\n<< /Type /XObject /Subtype /Image /Width {width} /Height {height} "
+                        f"/BitsPerComponent 8 /ColorSpace /DeviceRGB /Filter /FlateDecode /Length {len(data)} >>\n"
+                        "stream\n").encode() + data + b"\nendstream\nendobj\n"
+        info = f" /Info {trailer['Info'].objid} 0 R" if "Info" in trailer else ""
+        previous = int(re.findall(rb"startxref\s+(\d+)", sample)[-1])
+        xref = (f"xref\n{object_id} 1\n{len(sample) + 1:010d} 00000 n \n"
+                f"trailer\n<< /Size {trailer['Size']} /Root {trailer['Root'].objid} 0 R{info} /Prev {previous} >>\n"
+                f"startxref\n{len(sample) + 1 + len(image_object)}\n%%EOF\n").encode()
+        return sample + b"\n" + image_object + xref
+
+    @staticmethod
+    def get_risk(file_name: str) -> int:
+        """Risk drawn on the risk image of a PDF file, the same on every run.
+        """
+        return zlib.crc32(".".join(file_name.split(".")[:2]).encode()) % 5 + 1
+
+    def get_pdf(self, file_name: str) -> bytes:
+        """Content of a PDF file, varying with its name.
+        """
+        return self.samples[self.get_risk(file_name)] + f"\n% {file_name}\n".encode()
+
+    def _get_handler(self) -> type:
+        """Request handler class bound to this server.
+        """
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """Answer the GET requests of the downloader.
+            """
+
+            def do_GET(self):    # pylint: disable=C0103
+                """Serve an index or a PDF file.
+                """
+                name = self.path.lstrip("/")
+                if name.startswith("bra.") and name.endswith(".json"):
+                    content = json.dumps(server.get_index(name[4:-5])).encode()
+                elif name.startswith("BRA.") and name.split(".")[1] in server.massifs:
+                    content = server.get_pdf(name[4:])
+                else:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, *args):
+                """Keep the output quiet.
+                """
+
+        return Handler
+
+
+class DbStandIn():
+    """In-memory stand-in of the MySQL database, answering the queries of the pipeline and counting round-trips.
+    An optional latency is added to each round-trip, to simulate a remote database.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.links: Set[str] = set()
+        # Rows of the summary table, by (massif, day)
+        self.summaries: Dict[Tuple[str, str], Tuple[Any, ...]] = {}
+        self.round_trips = 0
+        self.lock = threading.Lock()
+
+    def round_trip(self) -> None:
+        """Count a round-trip to the database.
+        """
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def connect(self, **_) -> "StandInConnection":
+        """Replacement of pymysql.connect.
+        """
+        self.round_trip()
+        return StandInConnection(self)
+
+    def answer(self, query: str, data: Any = None) -> List[Dict[str, Any]]:
+        """Answer a query of the pipeline.
+        """
+        query = " ".join(query.replace("\\", " ").split())
+        if query.startswith("CREATE"):
+            return []
+        if "COUNT(original_link)" in query:
+            return [{"nb_files": len(self.links)}]
+        if query.startswith("SELECT DISTINCT original_link"):
+            if " IN (" in query:
+                return [{"original_link": link} for link in data if link in self.links]
+            return [{"original_link": link} for link in self.links]
+        if "ON DUPLICATE KEY UPDATE" in query:
+            # Upsert of the summary table, the greatest link being the latest bulletin
+            with self.lock:
+                for massif, date, risk_score, until, link in data:
+                    key = (massif, str(date)[0:10])
+                    if key not in self.summaries or link >= self.summaries[key][-1]:
+                        self.summaries[key] = (risk_score, until, link)
+            return []
+        if query.startswith("INSERT INTO"):
+            # The original link is the first column, a multi-row insert failing as a whole
+            rows = data if isinstance(data, list) else [data]
+            with self.lock:
+                for row in rows:
+                    if row[0] in self.links:
+                        raise pymysql.err.IntegrityError(1062, f"Duplicate entry '{row[0]}'")
+                self.links.update(row[0] for row in rows)
+            return []
+        raise NotImplementedError(f"Query not supported by the DB stand-in: {query[0:60]}")
+
+
+class StandInConnection():
+    """Connection to the DB stand-in.
+    """
+
+    def __init__(self, database: DbStandIn) -> None:
+        self.database = database
+        self.open = True
+
+    def cursor(self, cursor_class: type = None) -> "StandInCursor":
+        """Get a cursor, returning dicts for a DictCursor.
+        """
+        return StandInCursor(self.database, as_dict=cursor_class is pymysql.cursors.DictCursor)
+
+    def select_db(self, _: str) -> None:
+        """Select the database.
+        """
+        self.database.round_trip()
+
+    def commit(self) -> None:
+        """Commit.
+        """
+        self.database.round_trip()
+
+    def rollback(self) -> None:
+        """Rollback.
+        """
+        self.database.round_trip()
+
+    def close(self) -> None:
+        """Close.
+        """
+        self.open = False
+
+
+class StandInCursor():
+    """Cursor of the DB stand-in.
+    """
+
+    def __init__(self, database: DbStandIn, as_dict: bool) -> None:
+        self.database = database
+        self.as_dict = as_dict
+        self.rows: List[Any] = []
+        self.rowcount = 0
+
+    def __enter__(self) -> Any:
+        return self
+
+    def __exit__(self, *exec_info) -> None:
+        pass
+
+    def _set_rows(self, rows: List[Dict[str, Any]], rowcount: int) -> int:
+        """Store the result of a query.
+        """
+        self.rows = rows if self.as_dict else [tuple(row.values()) for row in rows]
+        self.rowcount = rowcount
+        return rowcount
+
+    def execute(self, query: str, data: Any = None) -> int:
+        """Execute a query in a round-trip.
+        """
+        self.database.round_trip()
+        rows = self.database.answer(query, data)
+        return self._set_rows(rows, len(rows) if rows else int(query.lstrip().startswith("INSERT")))
+
+    def executemany(self, query: str, data: List[Any]) -> int:
+        """Execute a multi-row insert in a single round-trip, as pymysql does when the query allows it, and else
+        one round-trip per row.
+        """
+        for _ in range(1 if RE_INSERT_VALUES.match(query) else len(data)):
+            self.database.round_trip()
+        return self._set_rows(self.database.answer(query, list(data)), len(data))
+
+    def fetchone(self) -> Any:
+        """Fetch the first row.
+        """
+        return self.rows[0] if self.rows else None
+
+    def fetchall(self) -> List[Any]:
+        """Fetch all rows.
+        """
+        return self.rows
+
+
+class StageTimer():
+    """Time the stages of the pipeline, by wrapping the methods doing them.
+    """
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.patched: List[Tuple[type, str, Callable]] = []
+
+    def wrap(self, owner: type, name: str, stage: str, replacement: Callable = None) -> None:
+        """Time the calls of a method, optionally replaced by another function.
+        """
+        original = getattr(owner, name)
+        function = replacement or original
+
+        @functools.wraps(original)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                with self.lock:
+                    self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+                    self.calls[stage] = self.calls.get(stage, 0) + 1
+
+        setattr(owner, name, timed)
+        self.patched.append((owner, name, original))
+
+    def restore(self) -> None:
+        """Restore the wrapped methods.
+        """
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched = []
+
+
+@dataclass
+class LoadTestReport:
+    """Result of a load test.
+    """
+    days: int = 0
+    massifs: int = 0
+    files: int = 0
+    """
+    Number of PDF files parsed.
+    """
+    seconds: float = 0.0
+    stages: Dict[str, float] = field(default_factory=dict)
+    """
+    Cumulated seconds of each stage. The DB writes run in a background thread, overlapping the others.
+    """
+    db_round_trips: int = 0
+    db_rows: int = 0
+    peak_rss_mib: float = 0.0
+    peak_children_rss_mib: float = 0.0
+    """
+    Peak memory of the child processes, such as Tesseract.
+    """
+
+    @property
+    def files_per_second(self) -> float:
+        """Throughput of the pipeline.
+        """
+        return self.files / self.seconds if self.seconds else 0.0
+
+    def report(self) -> str:
+        """Human readable report.
+        """
+        lines = [
+            f"{self.days} days x {self.massifs} massifs: {self.files} files in {self.seconds:.1f}s "
+            f"({self.files_per_second:.2f} files/s)",
+            f"Peak RSS: {self.peak_rss_mib:.0f} MiB (children: {self.peak_children_rss_mib:.0f} MiB)",
+            f"DB round-trips: {self.db_round_trips} ({self.db_rows} rows inserted)",
+            "Stages:",
+        ]
+        for stage, seconds in self.stages.items():
+            lines.append(f"\t- {stage}: {seconds:.2f}s ({100 * seconds / self.seconds if self.seconds else 0:.0f}%)")
+        return "\n".join(lines)
+
+
+def run_load_test(days: int,
+                  massifs: int,
+                  work_path: str,
+                  start: str = "20220101",
+                  sample_pdf: str = None,
+                  db_latency: float = 0.0,
+                  skip_ocr: bool = False,
+                  archive: bool = False,
+                  ocr_cache: str = "shared",
+                  run_script: str = None) -> LoadTestReport:
+    """Run run.py over several days of synthetic BRA, and measure it.
+    Every file being a clone of the same sample, they all have the same massif and date, but their risk image shows one
+    of the 5 risks. The OCR cache is kept for the whole backfill by default, as in production where it is stored in the
+    database: "daily" starts a new one every day, and "none" disables it to run the OCR on every image, an upper bound
+    of its cost.
+    """
+    if ocr_cache not in ["daily", "shared", "none"]:
+        raise ValueError(f"Unknown OCR cache mode {ocr_cache}")
+    sample_pdf = sample_pdf or os.path.join(ROOT_PATH, "tests", "data", "BEAUFORTAIN.20220228150738.pdf")
+    run_script = run_script or os.path.join(ROOT_PATH, "run.py")
+    database = DbStandIn(latency=db_latency)
+    timer = StageTimer()
+    timer.wrap(BraDownloader, "get_json_timestamp_file", "index")
+    timer.wrap(BraDownloader, "plan", "plan")
+    timer.wrap(BraDownloader, "get_pdf_file", "download")
+    timer.wrap(PdfParser, "_parse", "parse")
+    timer.wrap(PdfParser,
+               "_get_risk_ints",
+               "ocr",
+               replacement=(lambda _, image_paths: [None for _ in image_paths]) if skip_ocr else None)
+    timer.wrap(BraInserter, "exec_query", "db_queries")
+    timer.wrap(BraInserter, "_insert_batch", "db_writes")
+    environment = dict(os.environ)
+    connect = pymysql.connect
+    pymysql.connect = database.connect
+    start_time = time.perf_counter()
+    try:
+        with SyntheticBraServer(sample_pdf, massifs) as server:
+            for day in range(days):
+                date = (datetime.strptime(start, "%Y%m%d") + timedelta(days=day)).strftime("%Y%m%d")
+                for key in ["BRA_QUEUE_BATCH", "BRA_DRY_RUN", "BRA_ARCHIVE_FOLDER", "BRA_OCR_CACHE"]:
+                    os.environ.pop(key, None)
+                os.environ.update({
+                    "BRA_DATE": date,
+                    "BRA_BASE_URL": server.base_url,
+                    "BRA_LOG_FOLDER": os.path.join(work_path, "logs"),
+                    "BRA_PDF_FOLDER": os.path.join(work_path, "bra", date),
+                    "BRA_IMG_FOLDER": os.path.join(work_path, "img"),
+                    "MYSQL_USER": "load",
+                    "MYSQL_PWD": "test",
+                    "MYSQL_HOST": "127.0.0.1",
+                    "MYSQL_PORT": "3306",
+                    "MYSQL_DB": "bra",
+                    "MYSQL_TABLE": "france",
+                })
+                if archive:
+                    os.environ["BRA_ARCHIVE_FOLDER"] = os.path.join(work_path, "archive")
+                if ocr_cache == "none":
+                    os.environ["BRA_OCR_CACHE"] = ""
+                else:
+                    cache_name = date if ocr_cache == "daily" else "shared"
+                    os.environ["BRA_OCR_CACHE"] = os.path.join(work_path, "ocr_cache", f"{cache_name}.sqlite")
+                os.makedirs(os.environ["BRA_IMG_FOLDER"], exist_ok=True)
+                runpy.run_path(run_script, run_name="__main__")
+    finally:
+        pymysql.connect = connect
+        timer.restore()
+        os.environ.clear()
+        os.environ.update(environment)
+    return LoadTestReport(days=days,
+                          massifs=massifs,
+                          files=timer.calls.get("parse", 0),
+                          seconds=time.perf_counter() - start_time,
+                          stages=timer.seconds,
+                          db_round_trips=database.round_trips,
+                          db_rows=len(database.links),
+                          peak_rss_mib=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                          peak_children_rss_mib=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024)
+
+
+def main() -> None:
+    """Run a load test from the command line.
+    """
+    parser = argparse.ArgumentParser(description="Simulate a season backfill offline, and measure the pipeline.")
+    parser.add_argument("--days", type=int, default=7, help="Number of days")
+    parser.add_argument("--massifs", type=int, default=35, help="Number of massifs per day")
+    parser.add_argument("--start", default="20220101", help="First day, as YYYYMMDD")
+    parser.add_argument("--pdf", default=None, help="Sample BRA cloned for every massif")
+    parser.add_argument("--db-latency", type=float, default=0.0, help="Latency of a DB round-trip, in ms")
+    parser.add_argument("--skip-ocr", action="store_true", help="Do not run Tesseract")
+    parser.add_argument("--archive", action="store_true", help="Store the PDF files in an archive")
+    parser.add_argument("--ocr-cache",
+                        choices=["daily", "shared", "none"],
+                        default="shared",
+                        help="OCR cache shared by all the days (default), new every day, or disabled")
+    parser.add_argument("--json", action="store_true", help="Print the report as JSON")
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as work_path:
+        get_logger(base_path=os.path.join(work_path, "logs"), level=os.environ.get("BRA_LOG_LEVEL", "WARNING"))
+        report = run_load_test(args.days,
+                               args.massifs,
+                               work_path,
+                               start=args.start,
+                               sample_pdf=args.pdf,
+                               db_latency=args.db_latency / 1000,
+                               skip_ocr=args.skip_ocr,
+                               archive=args.archive,
+                               ocr_cache=args.ocr_cache)
+    if args.json:
+        print(json.dumps(dict(asdict(report), files_per_second=report.files_per_second)))
+    else:
+        print(report.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""Persistent cache of the risks read by OCR, keyed by the fingerprint of the risk image.
+"""
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Any, Callable, List, Optional, OrderedDict, Set, Tuple
+
+import pymysql
+
+from bra_database.utils import DbCredentials, RetryPolicy, get_logger
+
+
+@dataclass
+class CachedRisk:
+    """Risk voted by the OCR for an image, with the share of the votes it got.
+    """
+    risk: int
+    confidence: float
+
+
+class RiskOcrCache():
+    """Remember the risk read on each risk image, so that the OCR only runs on images never seen before.
+    Images are found by the hash of their pixels only: the risk crops are a single digit, and the perceptual hashes of
+    two different digits can be a bit apart. Readings with less than min_confidence of the votes are not trusted, and
+    read again. The least recently used images are evicted once the cache is full.
+    The entries are stored in a local SQLite file, see DbRiskOcrCache to store them in the database.
+    """
+
+    def __init__(self,
+                 cache_path: str = None,
+                 max_size: int = 1024,
+                 min_confidence: float = 0.5,
+                 logger: logging.Logger = None) -> None:
+        """Initialize the class, loading the stored entries.
+        """
+        self.logger = logger or get_logger()
+        self.cache_path = cache_path
+        self.max_size = max_size
+        self.min_confidence = min_confidence
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        # Entries used since loaded, their time of use being saved when closing
+        self.touched: Set[str] = set()
+        self._open()
+        # Entries in least recently used order, the storage only being read once
+        self.entries: OrderedDict[str, CachedRisk] = OrderedDict()
+        for digest, risk, confidence in self._load():
+            self.entries[digest] = CachedRisk(risk=risk, confidence=confidence)
+        self.logger.info(f"Loaded {len(self.entries)} OCR results")
+
+    def _open(self) -> None:
+        """Open the SQLite file, creating it if needed.
+        """
+        folder = os.path.dirname(self.cache_path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        self.index = sqlite3.connect(self.cache_path)
+        self.index.execute("""
+            CREATE TABLE IF NOT EXISTS risks (
+                digest TEXT PRIMARY KEY, risk INTEGER, confidence REAL, used REAL)
+        """)
+        self.index.commit()
+
+    def _load(self) -> List[Tuple[str, int, float]]:
+        """Stored entries, from the least recently used.
+        """
+        return self.index.execute("SELECT digest, risk, confidence FROM risks ORDER BY used").fetchall()
+
+    def _store(self, digest: str, risk: int, confidence: float) -> None:
+        """Store an entry.
+        """
+        self.index.execute("INSERT OR REPLACE INTO risks (digest, risk, confidence, used) VALUES (?, ?, ?, ?)",
+                           (digest, risk, confidence, time.time()))
+        self.index.commit()
+
+    def _delete(self, digests: List[str]) -> None:
+        """Delete evicted entries.
+        """
+        self.index.execute(f"DELETE FROM risks WHERE digest IN ({', '.join(['?' for _ in digests])})", digests)
+        self.index.commit()
+
+    def _save_use(self, digests: List[str]) -> None:
+        """Save that entries were used now, in a single statement.
+        """
+        self.index.execute(f"UPDATE risks SET used = ? WHERE digest IN ({', '.join(['?' for _ in digests])})",
+                           [time.time(), *digests])
+        self.index.commit()
+
+    def _close(self) -> None:
+        """Close the SQLite file.
+        """
+        self.index.close()
+
+    def __enter__(self) -> Any:
+        """Use the cache as a context manager.
+        """
+        return self
+
+    def __exit__(self, *exec_info) -> None:
+        """Close the cache.
+        """
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def close(self) -> None:
+        """Save the time of use of the entries used since loaded, and close the storage.
+        """
+        touched = [digest for digest in self.touched if digest in self.entries]
+        if touched:
+            self._save_use(touched)
+        self._close()
+
+    def _touch(self, digest: str) -> None:
+        """Mark an entry as the most recently used one.
+        """
+        self.entries.move_to_end(digest)
+        self.touched.add(digest)
+
+    def get(self, digest: str) -> Optional[CachedRisk]:
+        """Get the risk of an image by the hash of its pixels, if read with enough confidence.
+        """
+        entry = self.entries.get(digest)
+        if entry is None or entry.confidence < self.min_confidence:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._touch(digest)
+        return entry
+
+    def put(self, digest: str, risk: int, confidence: float) -> None:
+        """Store the risk of an image, evicting the least recently used ones if the cache is full.
+        """
+        self.entries[digest] = CachedRisk(risk=risk, confidence=confidence)
+        self._touch(digest)
+        self._store(digest, risk, confidence)
+        evicted = []
+        while len(self.entries) > self.max_size:
+            evicted.append(self.entries.popitem(last=False)[0])
+            self.logger.debug(f"Evicted OCR result of image {evicted[-1]}")
+        if evicted:
+            self._delete(evicted)
+
+    def report(self) -> str:
+        """Human readable counters of the cache.
+        """
+        lookups = self.hits + self.misses
+        return (f"OCR cache: {self.hits} hits, {self.misses} misses "
+                f"({100 * self.hits / lookups if lookups else 0:.0f}% hit rate), {len(self.entries)} entries")
+
+
+class DbRiskOcrCache(RiskOcrCache):
+    """OCR cache stored in a table of the database, so that it outlives the pods.
+    """
+
+    def __init__(self,
+                 credentials: DbCredentials,
+                 max_size: int = 1024,
+                 min_confidence: float = 0.5,
+                 logger: logging.Logger = None,
+                 retry_policy: RetryPolicy = None) -> None:
+        """Initialize the class, creating the table if needed and loading its entries.
+        """
+        self.credentials = credentials
+        self.retry_policy = retry_policy or self.credentials.retry_policy
+        self.table = f"{self.credentials.database}.{self.credentials.table}_ocr_cache"
+        super().__init__(max_size=max_size, min_confidence=min_confidence, logger=logger)
+
+    def _connect(self) -> pymysql.connections.Connection:
+        """Get a connection to the database.
+        """
+        return pymysql.connect(host=self.credentials.host,
+                               user=self.credentials.user,
+                               password=self.credentials.password,
+                               port=self.credentials.port,
+                               db=self.credentials.database)
+
+    def _call(self, function: Callable[[pymysql.cursors.Cursor], Any]) -> Any:
+        """Call a function with a cursor and commit, reconnecting and retrying if the connection is lost.
+        """
+
+        def call() -> Any:
+            if not self.connection.open:
+                self.connection = self._connect()
+            with self.connection.cursor() as cursor:
+                result = function(cursor)
+            self.connection.commit()
+            return result
+
+        return self.retry_policy.call(call)
+
+    def _open(self) -> None:
+        """Connect to the database, creating the table if needed.
+        """
+        self.connection = self.retry_policy.call(self._connect)
+        self._call(lambda cursor: cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {self.table} \
+            (digest CHAR(64) PRIMARY KEY, risk SMALLINT, confidence FLOAT, used DOUBLE) \
+            DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci;
+        """))
+
+    def _load(self) -> List[Tuple[str, int, float]]:
+        """Stored entries, from the least recently used.
+        """
+
+        def load(cursor: pymysql.cursors.Cursor) -> List[Tuple[str, int, float]]:
+            cursor.execute(f"SELECT digest, risk, confidence FROM {self.table} ORDER BY used")
+            return list(cursor.fetchall())
+
+        return self._call(load)
+
+    def _store(self, digest: str, risk: int, confidence: float) -> None:
+        """Store an entry, replacing the one of another worker.
+        """
+        self._call(lambda cursor: cursor.execute(
+            f"REPLACE INTO {self.table} (digest, risk, confidence, used) VALUES (%s, %s, %s, %s)",
+            (digest, risk, confidence, time.time())))
+
+    def _delete(self, digests: List[str]) -> None:
+        """Delete evicted entries.
+        """
+        self._call(lambda cursor: cursor.execute(
+            f"DELETE FROM {self.table} WHERE digest IN ({', '.join(['%s' for _ in digests])})", digests))
+
+    def _save_use(self, digests: List[str]) -> None:
+        """Save that entries were used now, in a single statement.
+        """
+        self._call(lambda cursor: cursor.execute(
+            f"UPDATE {self.table} SET used = %s WHERE digest IN ({', '.join(['%s' for _ in digests])})",
+            [time.time(), *digests]))
+
+    def _close(self) -> None:
+        """Close the connection.
+        """
+        self.connection.close()
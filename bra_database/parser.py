@@ -1,22 +1,29 @@
 """Module used to parse PDF files.
 """
+import hashlib
+import io
 import json
 import logging
 import os
 import re
+import tempfile
 from curses.ascii import isdigit
 from dataclasses import dataclass
 from datetime import datetime
 from enum import Enum
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 import cv2  # type: ignore
+import numpy
 import pdfplumber
 import pytesseract
 from pytesseract.pytesseract import TesseractError
 
+from bra_database.archive import BraArchive
+from bra_database.downloader import get_original_link
+from bra_database.ocr_cache import RiskOcrCache
 from bra_database.utils import (FrenchMonthsNumber, StabiliteManteauKeys,
-                                get_logger)
+                                StabiliteManteauSection, get_logger)
 
 
 @dataclass
@@ -86,15 +93,21 @@ class PdfParser():
     """Parse a PDF file and extract structured information to be used in IA models later.
     """
 
-    def __init__(self, logger: logging.Logger = None, image_output_path: str = None) -> None:
+    def __init__(self,
+                 logger: logging.Logger = None,
+                 image_output_path: str = None,
+                 ocr_cache: RiskOcrCache = None) -> None:
         """Initialise and set attributes.
         """
         self.logger = logger or get_logger()
         self.image_output_path = image_output_path if image_output_path else "/img"
+        # Risks already read on the same images
+        self.ocr_cache = ocr_cache
         # Utilities
         self.months = FrenchMonthsNumber()
         # Regexps used to parse the text
         self.regexps = Regexps
+        self.stabilite_manteau_keys = StabiliteManteauKeys()
 
     @staticmethod
     def _insert_info(structured_data: StructuredData, data: Any, key: str) -> StructuredData:
@@ -105,11 +118,11 @@ class PdfParser():
         return structured_data
 
     @staticmethod
-    def _get_from_regexp(text: str, regexp: str) -> str:
+    def _get_from_regexp(text: str, regexp: str, flags: int = 0) -> str:
         """Extract the first group match from a regexp.
         """
         try:
-            match = re.search(regexp, text).group(1).replace(".", "").lower()
+            match = re.search(regexp, text, flags).group(1).replace(".", "").lower()
         except AttributeError:
             match = None
         return match
@@ -161,46 +174,24 @@ class PdfParser():
         """
         return self._get_from_regexp(text, self.regexps.RISK.value)
 
-    def _get_stabilite_manteau(self, text: str) -> str:
-        """This bloc of text is less structured than others.
+    def _get_stabilite_manteau(self, text: str) -> Optional[Dict[str, StabiliteManteauSection]]:
+        """This bloc of text is less structured than others, its keys are mapped by the StabiliteManteauKeys.
         """
-        # We keep track of the \n
-        text_bloc = self._get_from_regexp(text.replace("\n", "::"), self.regexps.STABILITE.value)
+        text_bloc = self._get_from_regexp(text, self.regexps.STABILITE.value, re.DOTALL)
         if text_bloc:
-            # Find the text keys
-            r_keys = re.compile(r"\:\:([^:]*?) \: ?")
-            # There is only 3 keys: Situation typique, Départs spontanés and Déclenchements skieurs
-            # BUG: if a " : " is in the text, it will create more keys. It only works for now if the
-            # " : " is in the last block.
-            keys = re.findall(r_keys, text_bloc)[0:3]
-            self.logger.info(f"Keys: {', '.join(keys)}")
-            # The text of each key is retrieved behing this one and the next
-            texts = {}
-            for index, key in enumerate(keys):
-                if len(key) < 30:  # Allow to pass missformed keys
-                    self.logger.debug(key)
-                    try:
-                        next_key = keys[index + 1].translate(str.maketrans('','',"()[]"))
-                        regexp = re.compile(f"{key}(.*?){next_key}")
-                    except IndexError:
-                        regexp = re.compile(f"{key}(.*?)$")
-                    regexp_in_text = re.search(regexp, text_bloc)
-                    if regexp_in_text:
-                        text = " ".join(regexp_in_text.group(1).replace(":", " ").split())
-                        texts[key] = text
-            return json.dumps(texts, ensure_ascii=False)
+            sections = self.stabilite_manteau_keys.segment(text_bloc)
+            for key, section in sections.items():
+                self.logger.debug(f"Key: {section.title} -> {key} (confidence {section.confidence:.2f})")
+            return sections
         return None
 
     @staticmethod
-    def _insert_stabilite_manteau(structured_data: StructuredData, data: Dict[str, str]) -> StructuredData:
+    def _insert_stabilite_manteau(structured_data: StructuredData,
+                                  sections: Dict[str, StabiliteManteauSection]) -> StructuredData:
         """Insert stabilite manteau in a structured data object.
         """
-        key_words_relations = StabiliteManteauKeys()
-        # The keys of this text are not consdistent, they must be mapped.
-        for key, value in data.items():
-            best_match = key_words_relations.retrieve_best_match(key)
-            if best_match:
-                setattr(structured_data, best_match, value)
+        for key, section in sections.items():
+            setattr(structured_data, key, section.text)
         return structured_data
 
     def _get_qualite_neige(self, text: str) -> str:
@@ -222,48 +213,133 @@ class PdfParser():
         image_obj = cropped_page.to_image(resolution=400)
         image_obj.save(image_path)
 
-    def _get_risk_int(self, image_path: str) -> int:
-        """Analyse the image with OCR to extract the risk of avalanche.
-        Because yeah, the main score of this data is only accessible through an image.
+    @staticmethod
+    def _clean_ocr_output(raw_detection: str) -> str:
+        """Remove the blanks Tesseract adds around a detected character.
         """
-        self.logger.info(f"Analysing image {image_path}")
+        return raw_detection.replace("\n", "").replace("\x0c", "").replace(" ", "").encode("utf8").decode()
 
-        img = cv2.imread(image_path)    # pylint: disable=E1101
-        # Crop the image to reduce the noise in OCR
-        cropped_image = img[0:60, 0:60]
-        # Apply OCR with different models properties
-        chracters = []
-        for oem in range(0, 4):
-            for psm in range(0, 15):
-                custom_oem_psm_config = f"--oem {oem} --psm {psm}"
-                img_rgb = cv2.cvtColor(cropped_image, cv2.COLOR_BGR2RGB)    # pylint: disable=E1101
-                try:
-                    raw_detection = pytesseract.image_to_string(img_rgb, config=custom_oem_psm_config)
-                    character = raw_detection.replace("\n", "").replace("\x0c", "").replace(" ",
-                                                                                            "").encode("utf8").decode()
-                    if character != "" and isdigit(character):
-                        self.logger.debug(f"OEM: {oem}, PSM: {psm}, text: {character}")
-                        # If the character is a number, add it to the list
-                        chracters.append(character)
-                except (TesseractError, FileNotFoundError):
-                    continue
-        # Get the maximum represented item (maximum vote from CV2 model)
+    def _vote_risk(self, chracters: List[str], image_path: str) -> Tuple[Optional[int], float]:
+        """Get the maximum represented item (maximum vote from the OCR configurations), and its share of the votes.
+        """
+        if not chracters:
+            self.logger.error(f"OCR did not retrieve any digit from image {image_path}.")
+            return None, 0.0
         risk = max(chracters, key=chracters.count)
+        confidence = chracters.count(risk) / len(chracters)
         try:
             risk = int(risk)
         except ValueError:
             self.logger.error(f"OCR retrived max item {risk} that is not an integer among {chracters}.")
             risk = None
-        return risk
+        return risk, confidence
+
+    @staticmethod
+    def _get_fingerprint(crop: numpy.ndarray) -> str:
+        """Fingerprint a risk image by the hash of its pixels.
+        """
+        return hashlib.sha256(str(crop.shape).encode("utf8") + crop.tobytes()).hexdigest()
+
+    def _run_ocr(self, crops: List[numpy.ndarray]) -> List[List[str]]:
+        """Analyse a batch of cropped risk images with OCR, running Tesseract once per configuration for the batch.
+        The crops are written next to each other and given to Tesseract as an image list file: each image is a page of
+        the output, separated by a form feed, which allows to map the digits back to their source image.
+        """
+        votes: List[List[str]] = [[] for _ in crops]
+        debug = self.logger.isEnabledFor(logging.DEBUG)
+        with tempfile.TemporaryDirectory() as tmp_folder:
+            crop_paths = []
+            for index, crop in enumerate(crops):
+                crop_path = os.path.join(tmp_folder, f"{index}.png")
+                cv2.imwrite(crop_path, crop)    # pylint: disable=E1101
+                crop_paths.append(crop_path)
+            list_path = os.path.join(tmp_folder, "images.txt")
+            with open(list_path, "w", encoding="utf8") as list_file:
+                list_file.write("\n".join(crop_paths) + "\n")
+            # Apply OCR with different models properties
+            for oem in range(0, 4):
+                for psm in range(0, 15):
+                    custom_oem_psm_config = f"--oem {oem} --psm {psm}"
+                    try:
+                        raw_detection = pytesseract.image_to_string(list_path, config=custom_oem_psm_config)
+                    except (TesseractError, FileNotFoundError):
+                        continue
+                    pages = raw_detection.split("\x0c")
+                    # Depending on the Tesseract version, the separator also closes the last page
+                    if len(pages) == len(crops) + 1 and not pages[-1].strip():
+                        pages = pages[:-1]
+                    if len(pages) != len(crops):
+                        self.logger.error(f"OEM: {oem}, PSM: {psm}, got {len(pages)} pages for "
+                                          f"{len(crops)} images, ignoring this configuration.")
+                        continue
+                    for index, page in enumerate(pages):
+                        character = self._clean_ocr_output(page)
+                        if len(character) == 1 and isdigit(character):
+                            if debug:
+                                self.logger.debug(f"OEM: {oem}, PSM: {psm}, image: {index}, text: {character}")
+                            # If the character is a number, add it to the list
+                            votes[index].append(character)
+        return votes
 
-    def parse(self, file_path: str) -> None:
+    def _get_risk_ints(self, image_paths: List[str]) -> List[Optional[int]]:
+        """Analyse a batch of risk images with OCR, cropped to their 60x60 top left corner to reduce the noise.
+        With a cache, only the images never seen before go through the OCR, once per distinct image.
+        """
+        self.logger.info(f"Analysing {len(image_paths)} risk images")
+        crops = [cv2.imread(image_path)[0:60, 0:60] for image_path in image_paths]    # pylint: disable=E1101
+        if self.ocr_cache is None:
+            return [
+                self._vote_risk(chracters, image_path)[0]
+                for chracters, image_path in zip(self._run_ocr(crops), image_paths)
+            ]
+        risks: List[Optional[int]] = [None for _ in image_paths]
+        # Indexes of the images to analyse, grouped by digest
+        unknown: Dict[str, List[int]] = {}
+        digests = [self._get_fingerprint(crop) for crop in crops]
+        for index, digest in enumerate(digests):
+            if digest in unknown:
+                unknown[digest].append(index)
+                continue
+            cached = self.ocr_cache.get(digest)
+            if cached is not None:
+                risks[index] = cached.risk
+            else:
+                unknown[digest] = [index]
+        if unknown:
+            first_indexes = [indexes[0] for indexes in unknown.values()]
+            votes = self._run_ocr([crops[index] for index in first_indexes])
+            for chracters, (digest, indexes) in zip(votes, unknown.items()):
+                risk, confidence = self._vote_risk(chracters, image_paths[indexes[0]])
+                for index in indexes:
+                    risks[index] = risk
+                # Failed readings are not cached, to be tried again next time
+                if risk is not None:
+                    self.ocr_cache.put(digest, risk, confidence)
+        self.logger.info(self.ocr_cache.report())
+        return risks
+
+    def _get_risk_int(self, image_path: str) -> Optional[int]:
+        """Analyse the image with OCR to extract the risk of avalanche.
+        Because yeah, the main score of this data is only accessible through an image.
+        """
+        self.logger.info(f"Analysing image {image_path}")
+        return self._get_risk_ints([image_path])[0]
+
+    def _parse(self,
+               file_path: str,
+               ocr: bool = True,
+               archive: BraArchive = None,
+               image_folder: str = None) -> Tuple[StructuredData, Optional[str]]:
         """Parse a PDF file and extract informations based on regexps matching.
+        If an archive is given, the file is read in memory from it, based on its name.
+        Returns the structured data and the path of the extracted risk image, if any. With the OCR, the image is
+        deleted once read. Without, it is written in image_folder (image_output_path by default) for the caller.
         """
+        image_path = None
         self.logger.info(f"Parsing file {file_path}")
-        structured_data = StructuredData(
-            original_link=
-            f"https://donneespubliques.meteofrance.fr/donnees_libres/Pdf/BRA/BRA.{file_path.split('/')[-1]}")
-        with pdfplumber.open(file_path) as pdf:
+        structured_data = StructuredData(original_link=get_original_link(file_path.split('/')[-1]))
+        source = io.BytesIO(archive.read(structured_data.original_link)) if archive else file_path
+        with pdfplumber.open(source) as pdf:
             for index, page in enumerate(pdf.pages):
                 # Extracting informations
                 structured_data = self._insert_info(structured_data, self._get_massif(page.extract_text()), "massif")
@@ -278,11 +354,15 @@ class PdfParser():
                                                     "risk_str")
                 structured_data = self._insert_info(structured_data, self._get_qualite_neige(page.extract_text()),
                                                     "qualite_neige")
-                structured_data = self._insert_info(structured_data, self._get_stabilite_manteau(page.extract_text()),
-                                                    "stabilite_manteau_bloc")
-                # Now this JSON should be parsed to get the 3 resulting keys
-                structured_data = self._insert_stabilite_manteau(structured_data,
-                                                                 json.loads(structured_data.stabilite_manteau_bloc))
+                sections = self._get_stabilite_manteau(page.extract_text())
+                if sections is not None:
+                    # The bloc is stored as a JSON of its raw keys, and its sections mapped to the 3 resulting keys
+                    stabilite_manteau_bloc = json.dumps({section.title: section.text
+                                                         for section in sections.values()},
+                                                        ensure_ascii=False)
+                    structured_data = self._insert_info(structured_data, stabilite_manteau_bloc,
+                                                        "stabilite_manteau_bloc")
+                    structured_data = self._insert_stabilite_manteau(structured_data, sections)
                 # Extract the avalanche risk score from the image that contains it in the first page
                 if index == 0:
                     risk_image = [img for img in page.images if img["name"] == "Im10"]
@@ -290,10 +370,37 @@ class PdfParser():
                         self.logger.error(f"No risk image found in BRA {file_path}")
                     else:
                         image = risk_image[0]
-                        image_path = os.path.join(self.image_output_path, f"{structured_data.massif}_risks.jpg")
+                        image_name = os.path.splitext(os.path.basename(file_path))[0]
+                        image_path = os.path.join(image_folder or self.image_output_path, f"{image_name}_risks.jpg")
                         self.logger.info(f"Extracting risk image from page {index + 1} to {image_path}")
                         self._extract_and_save_image(page, image, image_path)
-                        structured_data = self._insert_info(structured_data, self._get_risk_int(image_path),
-                                                            "risk_score")
+                        if ocr:
+                            structured_data = self._insert_info(structured_data, self._get_risk_int(image_path),
+                                                                "risk_score")
+                            # One image per file would pile up in the image folder
+                            os.remove(image_path)
+                            image_path = None
+
+        return structured_data, image_path
 
+    def parse(self, file_path: str) -> StructuredData:
+        """Parse a PDF file, running the OCR on its risk image.
+        """
+        structured_data, _ = self._parse(file_path)
         return structured_data
+
+    def parse_batch(self, file_paths: List[str], archive: BraArchive = None) -> List[StructuredData]:
+        """Parse several PDF files, then run the OCR once on all their risk images.
+        """
+        parsed = []
+        # The risk images are only kept until the OCR of the batch
+        with tempfile.TemporaryDirectory(dir=self.image_output_path) as image_folder:
+            for index, file_path in enumerate(file_paths):
+                self.logger.info(f"Parsing file {index + 1}/{len(file_paths)}")
+                parsed.append(self._parse(file_path, ocr=False, archive=archive, image_folder=image_folder))
+            with_image = [(structured_data, image_path) for structured_data, image_path in parsed if image_path]
+            if with_image:
+                risks = self._get_risk_ints([image_path for _, image_path in with_image])
+                for (structured_data, _), risk in zip(with_image, risks):
+                    self._insert_info(structured_data, risk, "risk_score")
+        return [structured_data for structured_data, _ in parsed]
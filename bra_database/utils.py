@@ -1,12 +1,22 @@
 """Utilitary package.
 """
+import atexit
+import json
 import logging
+import math
 import os
+import queue
+import random
+import re
+import time
+import unicodedata
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from logging.handlers import QueueHandler, QueueListener
+from typing import Any, Callable, Dict, List, Optional
 
 import pymysql
+import requests
 from dotenv import load_dotenv
 
 
@@ -20,8 +30,12 @@ class DbCredentials:
                  host: str = None,
                  port: int = None,
                  database: str = None,
-                 logger: logging.Logger = None) -> None:
+                 logger: logging.Logger = None,
+                 retry_policy: "RetryPolicy" = None) -> None:
         self.logger = logger or get_logger()
+        # Retry policy shared by all the database calls
+        self.retry_policy = retry_policy or RetryPolicy(
+            "MySQL", is_retryable=is_retryable_db_error, logger=self.logger)
         # Load .env file
         load_dotenv()
         self.user = username or self._try_to_get_key("MYSQL_USER")
@@ -32,9 +46,9 @@ class DbCredentials:
         self.table = database or self._try_to_get_key("MYSQL_TABLE")
         # Say hello
         try:
-            self._handshake()
+            self.retry_policy.call(self._handshake)
         except pymysql.err.ProgrammingError as error:
-            logger.error(f"Error while connecting to the database: {error}. Maybe it needs to be created later.")
+            self.logger.error(f"Error while connecting to the database: {error}. Maybe it needs to be created later.")
 
     def _handshake(self) -> None:
         """Get the number of already treated files in the DB.
@@ -48,10 +62,13 @@ class DbCredentials:
                                      password=self.password,
                                      port=self.port,
                                      db=self.database)
-        with connection.cursor(pymysql.cursors.DictCursor) as cursor:
-            cursor.execute(query)
-            self.inserted_files = cursor.fetchone()["nb_files"]
-            self.logger.info(f"Found {self.inserted_files} files in the database.")
+        try:
+            with connection.cursor(pymysql.cursors.DictCursor) as cursor:
+                cursor.execute(query)
+                self.inserted_files = cursor.fetchone()["nb_files"]
+                self.logger.info(f"Found {self.inserted_files} files in the database.")
+        finally:
+            connection.close()
 
     @staticmethod
     def _try_to_get_key(key: str) -> Optional[str]:
@@ -108,52 +125,281 @@ class FrenchMonthsNumber:
         return [month for month in dir(self) if getattr(self, month) == month_number][0]
 
 
+def normalize_text(text: str) -> str:
+    """Lower a text and remove its accents, keeping exactly one character per input character.
+    """
+    return "".join(unicodedata.normalize("NFD", char.lower())[0] for char in text)
+
+
+@dataclass
+class StabiliteManteauSection:
+    """A section of the "Stabilité du manteau neigeux" text bloc.
+    """
+    title: str
+    text: str
+    confidence: float
+    """
+    Share of the keywords found in the title pointing to this section.
+    """
+
+
 class StabiliteManteauKeys():
     """
     Under the "Stabilité du manteau neigeux" text bloc, the keys of the text are not consistents.
-    To structure them, for now, this class only store words that should be retireved.
+    To structure them, this class store words that should be retrieved, compiled once into a single regexp.
     """
 
     def __init__(self):
-        self.situation_avalancheuse_typique: List[str] = ["typique", "avalancheuse"]
-        self.departs_spontanes: List[str] = ["spontané", "naturels"]
-        self.declanchements_provoques: List[str] = [
-            "skieurs", "déclanchement", "déclenchements", "provoqués", "declenchements", "accidentels"
-        ]
+        self.keywords: Dict[str, List[str]] = {
+            "situation_avalancheuse_typique": ["typique", "avalancheuse"],
+            "departs_spontanes": ["spontané", "naturels"],
+            "declanchements_provoques": [
+                "skieurs", "déclanchement", "déclenchements", "provoqués", "declenchements", "accidentels"
+            ],
+        }
+        # One named group per key, the words being compared without accents nor case
+        self.r_keywords = re.compile("|".join(
+            f"(?P<{key}>{'|'.join(sorted({re.escape(normalize_text(word)) for word in words}))})"
+            for key, words in self.keywords.items()))
+        # A title is a short text at the beginning of a line, followed by a colon
+        self.r_titles = re.compile(r"^[ \t]*([^:\n]{1,30}?)[ \t]*:", re.MULTILINE)
+
+    def _count_matches(self, text: str) -> Dict[str, int]:
+        """Count the keywords of each key found in a text.
+        """
+        matches: Dict[str, int] = {}
+        for match in self.r_keywords.finditer(normalize_text(text)):
+            matches[match.lastgroup] = matches.get(match.lastgroup, 0) + 1
+        return matches
+
+    def _best_key(self, matches: Dict[str, int]) -> str:
+        """Get the key with the most keywords found, the first declared one winning ties.
+        """
+        return max(self.keywords, key=lambda key: matches.get(key, 0))
 
     def retrieve_best_match(self, text: str) -> Optional[str]:
         """Retrieve the best match of a text in the list of keys.
         """
-        for key, words in self.__dict__.items():
-            for word in words:
-                if word in text:
-                    return key
+        matches = self._count_matches(text)
+        if not matches:
+            return None
+        return self._best_key(matches)
+
+    def segment(self, text_bloc: str) -> Dict[str, StabiliteManteauSection]:
+        """Split the text bloc into its sections in a single pass over its titles.
+        Only titles containing a keyword start a section, so a " : " inside a text does not create a new key.
+        """
+        titles = []
+        for match in self.r_titles.finditer(normalize_text(text_bloc)):
+            matches = self._count_matches(match.group(1))
+            if matches:
+                key = self._best_key(matches)
+                titles.append((key, matches[key] / sum(matches.values()), match))
+        sections: Dict[str, StabiliteManteauSection] = {}
+        for index, (key, confidence, match) in enumerate(titles):
+            end = titles[index + 1][2].start() if index + 1 < len(titles) else len(text_bloc)
+            section = StabiliteManteauSection(title=text_bloc[match.start(1):match.end(1)].strip(),
+                                              text=" ".join(text_bloc[match.end():end].replace(":", " ").split()),
+                                              confidence=confidence)
+            if key not in sections or sections[key].confidence < section.confidence:
+                sections[key] = section
+        return sections
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a service considered down.
+    """
+
+
+def is_retryable_http_error(error: Exception) -> bool:
+    """Connection errors, timeouts, server errors and throttling are worth a retry, not client errors such as 404.
+    """
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500 or error.response.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+
+def is_retryable_db_error(error: Exception) -> bool:
+    """Lost connections and lock timeouts are worth a retry, not integrity or SQL errors.
+    """
+    return isinstance(error, (pymysql.err.OperationalError, pymysql.err.InterfaceError))
+
+
+class Deadline():
+    """Time budget of a run, shared by its retry policies.
+    """
+
+    def __init__(self, seconds: float = None) -> None:
+        self.end = time.monotonic() + seconds if seconds is not None else None
+
+    def remaining(self) -> float:
+        """Seconds left before the deadline.
+        """
+        if self.end is None:
+            return math.inf
+        return max(self.end - time.monotonic(), 0.0)
+
+
+class CircuitBreaker():
+    """Stop calling a service after several consecutive failures, and let a call through again after some time.
+    """
+
+    def __init__(self, threshold: int = 5, reset_timeout: float = 60.0) -> None:
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+
+    def allow(self) -> bool:
+        """Check if the service can be called.
+        """
+        if self.opened_at is None:
+            return True
+        # Half open: once the timeout is over, calls are let through until the next failure
+        return time.monotonic() - self.opened_at >= self.reset_timeout
+
+    def record_success(self) -> None:
+        """Close the circuit.
+        """
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self) -> None:
+        """Count a failure, opening the circuit beyond the threshold.
+        """
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+
+
+class RetryPolicy():
+    """Retry a call with an exponential backoff and a full jitter, within a deadline and behind a circuit breaker.
+    Errors that are not retryable are raised at once, and no retry is done if its delay exceeds the deadline.
+    """
+
+    def __init__(self,
+                 name: str,
+                 is_retryable: Callable[[Exception], bool],
+                 tries: int = 5,
+                 base_delay: float = 1.0,
+                 max_delay: float = 60.0,
+                 deadline: Deadline = None,
+                 breaker: CircuitBreaker = None,
+                 logger: logging.Logger = None) -> None:
+        self.name = name
+        self.is_retryable = is_retryable
+        self.tries = tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline or Deadline()
+        self.breaker = breaker or CircuitBreaker()
+        self.logger = logger or get_logger()
+
+    def _get_delay(self, attempt: int) -> float:
+        """Random delay before a retry, its maximum growing exponentially.
+        """
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))    # nosec
+
+    def call(self, function: Callable[[], Any]) -> Any:
+        """Call a function, retrying it on retryable errors.
+        """
+        for attempt in range(self.tries):
+            if not self.breaker.allow():
+                raise CircuitOpenError(f"{self.name} is considered down after {self.breaker.failures} failures")
+            try:
+                result = function()
+            except Exception as error:    # pylint: disable=W0703
+                if not self.is_retryable(error):
+                    raise
+                self.breaker.record_failure()
+                delay = self._get_delay(attempt)
+                if attempt + 1 == self.tries or delay > self.deadline.remaining():
+                    self.logger.error(f"{self.name} call failed after {attempt + 1} tries: {error}")
+                    raise
+                self.logger.warning(f"{self.name} call failed ({error}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+            else:
+                self.breaker.record_success()
+                return result
         return None
 
 
-def get_logger(base_path: str = "logs", file_name: str = None) -> logging.Logger:
+class JsonFormatter(logging.Formatter):
+    """Format the log records as JSON lines, to be read by log processing tools.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        """Format a record as a JSON object.
+        """
+        output = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "module": record.module,
+            "message": record.getMessage()
+        }
+        return json.dumps(output, ensure_ascii=False)
+
+
+# Background thread writing the log records, and the log file it writes to
+_LOG_LISTENER: Optional[QueueListener] = None
+_LOG_PATH: Optional[str] = None
+
+
+def _stop_log_listener() -> None:
+    """Write the remaining log records and stop the background thread.
+    """
+    global _LOG_LISTENER    # pylint: disable=W0603
+    if _LOG_LISTENER:
+        _LOG_LISTENER.stop()
+        _LOG_LISTENER = None
+
+
+atexit.register(_stop_log_listener)
+
+
+def get_logger(base_path: str = None,
+               file_name: str = None,
+               level: str = None,
+               json_format: bool = None) -> logging.Logger:
     """Define and returns a logger.
+    Records are put in a queue and written to the console and the log file by a background thread, so logging never
+    blocks on I/O. Calling it again is a no-op, unless another log file or level is asked. By default, the level and
+    the format come from the BRA_LOG_LEVEL (INFO) and BRA_LOG_FORMAT ("json" for JSON lines) environment variables.
     """
+    global _LOG_LISTENER, _LOG_PATH    # pylint: disable=W0603
     logger = logging.getLogger(__name__)
-    logger.setLevel(logging.DEBUG)
-    # Format
-    formatter = logging.Formatter("%(asctime)s : %(levelname)s : %(name)s : %(message)s")
-    # Stream handler
-    if not logger.handlers:
-        stream_handler = logging.StreamHandler()
-        stream_handler.setFormatter(formatter)
-        logger.addHandler(stream_handler)
-    # File handler
+    if level or not _LOG_LISTENER:
+        logger.setLevel((level or os.environ.get("BRA_LOG_LEVEL", "INFO")).upper())
+    if _LOG_LISTENER and base_path is None and file_name is None:
+        return logger
+    # Log file, appended if it exists
+    base_path = base_path or "logs"
     if not os.path.exists(base_path):
         os.makedirs(base_path)
     if not file_name:
         execution_date = datetime.today().strftime("%Y%m%d")
         file_name = f"{execution_date}_bra_database.log"
     log_path = os.path.join(base_path, file_name)
-    if os.path.exists(log_path):
-        os.remove(log_path)
-    file_handler = logging.FileHandler(log_path)
+    if _LOG_LISTENER and log_path == _LOG_PATH:
+        return logger
+    _stop_log_listener()
+    # Format
+    if json_format is None:
+        json_format = os.environ.get("BRA_LOG_FORMAT") == "json"
+    if json_format:
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s : %(levelname)s : %(name)s : %(message)s")
+    # Stream and file handlers, used by the background thread
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    file_handler = logging.FileHandler(log_path, encoding="utf8")
     file_handler.setFormatter(formatter)
-    logger.addHandler(file_handler)
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.handlers = [QueueHandler(log_queue)]
+    _LOG_LISTENER = QueueListener(log_queue, stream_handler, file_handler)
+    _LOG_LISTENER.start()
+    _LOG_PATH = log_path
 
     return logger
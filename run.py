@@ -5,10 +5,14 @@ import os
 
 from dotenv import load_dotenv
 
-from bra_database.downloader import BraDownloader
+from bra_database.archive import BraArchive
+from bra_database.downloader import METEO_FRANCE_URL, BraDownloader
 from bra_database.inserter import BraInserter
+from bra_database.leases import BraWorkQueue
+from bra_database.ocr_cache import DbRiskOcrCache, RiskOcrCache
 from bra_database.parser import PdfParser
-from bra_database.utils import DbCredentials, get_logger
+from bra_database.utils import (Deadline, DbCredentials, RetryPolicy, get_logger, is_retryable_db_error,
+                                is_retryable_http_error)
 
 # Load credentials if found locally
 load_dotenv()
@@ -27,27 +31,115 @@ except KeyError:
     base_path = os.path.join(os.sep, "logs")
 logger = get_logger(base_path=base_path, file_name=f"{today}_bra_database.log")
 
+# Retries of Météo-France and MySQL calls share a time budget, in seconds
+try:
+    deadline = Deadline(float(os.environ["BRA_RETRY_BUDGET"]))
+except KeyError:
+    deadline = Deadline(1800)
+
 # Download PDF files
 try:
     pdf_path = os.environ["BRA_PDF_FOLDER"]
 except KeyError:
     pdf_path = os.path.join(os.sep, "bra", today)
-if not os.path.exists(pdf_path):
-    os.makedirs(pdf_path)
-downloader = BraDownloader(pdf_path=pdf_path, logger=logger)
+# If an archive is used, PDF files are stored once by content instead of in a folder per day
+try:
+    archive = BraArchive(os.environ["BRA_ARCHIVE_FOLDER"], logger=logger)
+except KeyError:
+    archive = None
+    if not os.path.exists(pdf_path):
+        os.makedirs(pdf_path)
+# The BRA can be downloaded from a mirror
+try:
+    base_url = os.environ["BRA_BASE_URL"]
+except KeyError:
+    base_url = METEO_FRANCE_URL
+downloader = BraDownloader(pdf_path=pdf_path,
+                           logger=logger,
+                           archive=archive,
+                           base_url=base_url,
+                           retry_policy=RetryPolicy("Météo-France",
+                                                    is_retryable=is_retryable_http_error,
+                                                    deadline=deadline,
+                                                    logger=logger))
 downloader.get_json_timestamp_file(date=today)
-downloader.get_pdf_files()
 
 # Prepare the PDF parser and the DB credentials
-credentials = DbCredentials(logger=logger)
+credentials = DbCredentials(logger=logger,
+                            retry_policy=RetryPolicy("MySQL",
+                                                     is_retryable=is_retryable_db_error,
+                                                     deadline=deadline,
+                                                     logger=logger))
 try:
     image_output_path = os.environ["BRA_IMG_FOLDER"]
 except KeyError:
     image_output_path = os.path.join(os.sep, "img")
-parser = PdfParser(logger=logger, image_output_path=image_output_path)
+# Risks read by OCR are remembered from a run to the next one, by risk image, in the database by default
+try:
+    ocr_cache_path = os.environ["BRA_OCR_CACHE"]
+    # An empty path disables the cache
+    ocr_cache = RiskOcrCache(ocr_cache_path, logger=logger) if ocr_cache_path else None
+except KeyError:
+    ocr_cache = DbRiskOcrCache(credentials=credentials, logger=logger)
+parser = PdfParser(logger=logger, image_output_path=image_output_path, ocr_cache=ocr_cache)
+
+# Several workers (pods or local processes) can split the files of the day through leases stored in the DB
+try:
+    queue_batch_size = int(os.environ["BRA_QUEUE_BATCH"])
+except KeyError:
+    queue_batch_size = None
+
+# A dry run only reports the files that would be processed
+try:
+    dry_run = os.environ["BRA_DRY_RUN"] == "1"
+except KeyError:
+    dry_run = False
+
+# Rows are written to the DB by a background thread, while the next files are parsed
+with BraInserter(credentials=credentials, logger=logger, asynchronous=True) as inserter:
+    # Only the files of the day that are not in the database yet are downloaded and parsed
+    work_plan = downloader.plan(inserter.list_inserted_links(downloader.list_original_links()))
+    logger.info(work_plan.report())
+    if dry_run:
+        logger.info("Dry run: nothing is downloaded nor parsed.")
+    elif queue_batch_size:
+        with BraWorkQueue(credentials=credentials, logger=logger) as queue:
+            queue.enqueue(today, work_plan.items)
+            while True:
+                items = queue.claim(today, size=queue_batch_size)
+                if not items:
+                    break
+                # Leases are renewed between the stages, the items taken over by another worker being dropped
+                held = items
+                downloaded = []
+                for item in items:
+                    if item in held:
+                        file_name = downloader.get_pdf_file(*item)
+                        # Files that can not be downloaded are skipped
+                        if file_name:
+                            downloaded.append((item, file_name))
+                        held = queue.renew(held)
+                downloaded = [(item, file_name) for item, file_name in downloaded if item in held]
+                file_names = [file_name for _, file_name in downloaded]
+                file_paths = file_names if archive else [os.path.join(pdf_path, file) for file in file_names]
+                parsed = parser.parse_batch(file_paths, archive=archive)
+                # Only the rows of the items still held are written
+                held = queue.renew(held)
+                for (item, _), structured_data in zip(downloaded, parsed):
+                    if item in held:
+                        inserter.insert(structured_data)
+                # Items are only done once their rows are written
+                inserter.flush()
+                queue.complete(held)
+    else:
+        downloader.get_pdf_files(work_plan.items)
+        # Parse all the files, the OCR being run once on the whole batch of risk images
+        if archive:
+            file_paths = downloader.file_name
+        else:
+            file_paths = [os.path.join(pdf_path, file) for file in downloader.file_name]
+        for structured_data in parser.parse_batch(file_paths, archive=archive):
+            inserter.insert(structured_data)
 
-for index, file in enumerate(os.listdir(pdf_path)):
-    logger.info(f"Parsing file {index + 1}/{len(os.listdir(pdf_path))}")
-    structured_data = parser.parse(os.path.join(pdf_path, file))
-    with BraInserter(credentials=credentials, logger=logger) as inserter:
-        inserter.insert(structured_data)
+if ocr_cache:
+    ocr_cache.close()
@@ -0,0 +1,72 @@
+"""Test covering the archive class.
+"""
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+from bra_database.archive import BraArchive
+
+
+def _put(archive_path: str, worker: int) -> None:
+    """Archive some files from another process.
+    """
+    with BraArchive(archive_path, max_pack_size=1024) as archive:
+        for index in range(200):
+            archive.put(f"BRA.{worker}.{index}.pdf", f"content {worker} {index} ".encode() * 50)
+
+
+class ArchiveTests(unittest.TestCase):
+    """Test cases for the archive class.
+    """
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.archive = BraArchive(self.tmp, max_pack_size=1024)
+        with open(os.path.join(os.path.dirname(__file__), "data", "BEAUFORTAIN.20220228150738.pdf"), "rb") as pdf:
+            self.pdf = pdf.read()
+
+    def tearDown(self) -> None:
+        self.archive.close()
+        shutil.rmtree(self.tmp)
+
+    def test_put_and_read(self):
+        """Test that a same content is stored once and read back identical.
+        """
+        digest = self.archive.put("BRA.BEAUFORTAIN.1.pdf", self.pdf)
+        self.assertEqual(self.archive.put("BRA.BEAUFORTAIN.2.pdf", self.pdf), digest)
+        self.assertTrue(self.archive.contains("BRA.BEAUFORTAIN.2.pdf"))
+        self.assertFalse(self.archive.contains("BRA.BEAUFORTAIN.3.pdf"))
+        self.assertEqual(self.archive.read("BRA.BEAUFORTAIN.1.pdf"), self.pdf)
+        self.assertEqual(self.archive.index.execute("SELECT COUNT(*) FROM blobs").fetchone()[0], 1)
+        with self.assertRaises(KeyError):
+            self.archive.read("BRA.BEAUFORTAIN.3.pdf")
+
+    def test_gc(self):
+        """Test that the garbage collection drops unreferenced blobs and keeps the others readable.
+        """
+        self.archive.put("BRA.A.pdf", self.pdf)
+        self.archive.put("BRA.B.pdf", b"another content" * 100)
+        self.archive.put("BRA.C.pdf", self.pdf)
+        self.assertEqual(self.archive.gc(), 0)
+        self.archive.remove("BRA.A.pdf")
+        self.assertEqual(self.archive.gc(), 0)
+        self.archive.remove("BRA.C.pdf")
+        self.assertGreater(self.archive.gc(), 0)
+        self.assertEqual(self.archive.list_links(), ["BRA.B.pdf"])
+        self.assertEqual(self.archive.read("BRA.B.pdf"), b"another content" * 100)
+
+    def test_several_writers(self):
+        """Test that several processes writing in the same archive do not corrupt its packs.
+        """
+        workers = [multiprocessing.Process(target=_put, args=(self.tmp, worker)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(len(self.archive.list_links()), 800)
+        for worker in range(4):
+            for index in range(200):
+                self.assertEqual(self.archive.read(f"BRA.{worker}.{index}.pdf"),
+                                 f"content {worker} {index} ".encode() * 50)
@@ -1,11 +1,20 @@
 """Test covering the downloader class.
 """
+import json
 import os
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
 
-from bra_database.downloader import BraDownloader
+import requests
+
+from bra_database.downloader import BraDownloader, get_original_link
+from bra_database.utils import (CircuitBreaker, CircuitOpenError, Deadline, RetryPolicy,
+                                is_retryable_http_error)
 
 
 class DownloaderTests(unittest.TestCase):
@@ -35,3 +44,125 @@ class DownloaderTests(unittest.TestCase):
         self.downloader.timestamps_bra = self.downloader.timestamps_bra[0:1]
         self.downloader.get_pdf_files()
         self.assertTrue(len(os.listdir(self.tmp)) == 1)
+
+    def test_plan(self):
+        """Test that the plan leaves out the files already in the database, and knows the downloaded ones.
+        """
+        self.downloader.timestamps_bra = [{"massif": "A", "heures": ["1", "2"]}, {"massif": "B", "heures": ["1"]}]
+        with open(os.path.join(self.tmp, "B.1.pdf"), "wb") as pdf:
+            pdf.write(b"%PDF-1.4")
+        work_plan = self.downloader.plan({get_original_link("A.1.pdf")})
+        self.assertEqual(work_plan.listed, 3)
+        self.assertEqual(work_plan.inserted, 1)
+        self.assertEqual(work_plan.items, [("A", "2"), ("B", "1")])
+        self.assertEqual(work_plan.cached, {"B.1.pdf"})
+        self.assertIn("3 BRA listed, 1 already in the database, 2 to process (1 to download)", work_plan.report())
+
+
+class FaultyHandler(BaseHTTPRequestHandler):
+    """Stand-in for Météo-France, failing the first requests of some paths.
+    """
+    # Path: (status of the failures, number of failures, content once working), a 200 failure being a truncated body
+    routes: Dict[str, Tuple[int, int, bytes]] = {}
+    requests: Dict[str, int] = {}
+
+    def do_GET(self):    # pylint: disable=C0103
+        """Answer a GET request.
+        """
+        self.requests[self.path] = self.requests.get(self.path, 0) + 1
+        status, failures, content = self.routes.get(self.path, (404, 1, b""))
+        if self.requests[self.path] <= failures:
+            self.send_response(status)
+            if status == 200:
+                # The connection drops in the middle of the body
+                self.send_header("Content-Length", str(len(content) + 1000))
+                self.end_headers()
+                self.wfile.write(content[0:16])
+                return
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        """Keep the tests output quiet.
+        """
+
+
+class RetryDownloaderTests(unittest.TestCase):
+    """Test cases for the retries of the downloader, against a local faulty server.
+    """
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        FaultyHandler.requests = {}
+        FaultyHandler.routes = {
+            "/bra.20220303.json": (503, 2, json.dumps([{"massif": "A", "heures": ["1"]}]).encode()),
+            "/BRA.A.1.pdf": (500, 1, b"%PDF-1.4"),
+            "/BRA.DOWN.1.pdf": (503, 100, b""),
+            "/BRA.CUT.1.pdf": (200, 1, b"%PDF-1.4" + b"0" * 100),
+        }
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), FaultyHandler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _get_downloader(self, **kwargs) -> BraDownloader:
+        """Downloader with short delays.
+        """
+        policy = RetryPolicy("Stand-in", is_retryable=is_retryable_http_error, base_delay=0.01, **kwargs)
+        return BraDownloader(self.tmp, base_url=self.base_url, retry_policy=policy)
+
+    def test_retry_server_errors(self):
+        """Test that server errors are retried until the files are downloaded.
+        """
+        downloader = self._get_downloader()
+        downloader.get_json_timestamp_file(date="20220303")
+        downloader.get_pdf_files()
+        self.assertEqual(downloader.timestamps_bra, [{"massif": "A", "heures": ["1"]}])
+        self.assertEqual(os.listdir(self.tmp), ["A.1.pdf"])
+        self.assertEqual(FaultyHandler.requests, {"/bra.20220303.json": 3, "/BRA.A.1.pdf": 2})
+
+    def test_truncated_body(self):
+        """Test that a connection dropping in the middle of a file is retried, without leaving a partial file.
+        """
+        downloader = self._get_downloader()
+        self.assertEqual(downloader.get_pdf_file("CUT", "1"), "CUT.1.pdf")
+        self.assertEqual(FaultyHandler.requests, {"/BRA.CUT.1.pdf": 2})
+        self.assertEqual(os.listdir(self.tmp), ["CUT.1.pdf"])
+        with open(os.path.join(self.tmp, "CUT.1.pdf"), "rb") as pdf:
+            self.assertEqual(pdf.read(), b"%PDF-1.4" + b"0" * 100)
+
+    def test_not_found_is_skipped(self):
+        """Test that a missing file is not retried, but skipped.
+        """
+        downloader = self._get_downloader()
+        self.assertIsNone(downloader.get_pdf_file("MISSING", "1"))
+        self.assertEqual(FaultyHandler.requests, {"/BRA.MISSING.1.pdf": 1})
+        self.assertEqual(downloader.file_name, [])
+
+    def test_circuit_breaker(self):
+        """Test that a service down is not called anymore once the circuit is open.
+        """
+        downloader = self._get_downloader(breaker=CircuitBreaker(threshold=2))
+        with self.assertRaises(CircuitOpenError):
+            downloader.get_pdf_file("DOWN", "1")
+        with self.assertRaises(CircuitOpenError):
+            downloader.get_pdf_file("A", "1")
+        self.assertEqual(FaultyHandler.requests, {"/BRA.DOWN.1.pdf": 2})
+
+    def test_deadline(self):
+        """Test that no retry is done beyond the deadline.
+        """
+        downloader = self._get_downloader(deadline=Deadline(0.5))
+        downloader.retry_policy.base_delay = 10
+        start = time.monotonic()
+        with self.assertRaises(requests.HTTPError):
+            downloader.get_pdf_file("DOWN", "1")
+        self.assertLess(time.monotonic() - start, 1)
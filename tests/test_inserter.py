@@ -0,0 +1,121 @@
+"""Test covering the inserter class.
+"""
+import unittest
+from datetime import date, datetime
+from unittest import mock
+
+from pymysql.cursors import RE_INSERT_VALUES
+from pymysql.err import IntegrityError, OperationalError
+
+from bra_database.inserter import BraInserter
+from bra_database.parser import StructuredData
+from bra_database.utils import RetryPolicy, is_retryable_db_error
+
+
+class InserterTests(unittest.TestCase):
+    """Test cases for the inserter class, the database connection being mocked.
+    """
+
+    def setUp(self) -> None:
+        self.credentials = mock.MagicMock(database="bra", table="france")
+        self.credentials.retry_policy = RetryPolicy("MySQL", is_retryable=is_retryable_db_error, tries=1)
+        self.patcher = mock.patch("pymysql.connect")
+        self.connect = self.patcher.start()
+
+    def tearDown(self) -> None:
+        self.patcher.stop()
+
+    def _get_cursor(self) -> mock.MagicMock:
+        """Cursor used by the connections.
+        """
+        return self.connect.return_value.cursor.return_value.__enter__.return_value
+
+    def test_asynchronous_batches(self):
+        """Test that the background writer inserts by batches and drains its queue on exit.
+        """
+        with BraInserter(credentials=self.credentials, asynchronous=True, batch_size=2) as inserter:
+            for index in range(5):
+                inserter.insert(StructuredData(original_link=f"link_{index}", massif="beaufortain"))
+        batches = [call.args[1] for call in self._get_cursor().executemany.call_args_list]
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(batches[0][0][0], "link_0")
+
+    def test_flush(self):
+        """Test that a flush writes the current batch without waiting for it to be full.
+        """
+        with BraInserter(credentials=self.credentials, asynchronous=True, batch_size=10,
+                         flush_interval=60) as inserter:
+            inserter.insert(StructuredData(original_link="link_0"))
+            inserter.flush()
+            self.assertEqual(self._get_cursor().executemany.call_count, 1)
+
+    def test_asynchronous_error(self):
+        """Test that an error of the background writer is raised in the caller.
+        """
+        self._get_cursor().executemany.side_effect = OperationalError("Lost connection")
+        with self.assertRaises(OperationalError):
+            with BraInserter(credentials=self.credentials, asynchronous=True, batch_size=1) as inserter:
+                for index in range(5):
+                    inserter.insert(StructuredData(original_link=f"link_{index}"))
+
+    def test_asynchronous_error_is_sticky(self):
+        """Test that after an error, the writer writes nothing more and the error is raised until the end.
+        """
+        self._get_cursor().executemany.side_effect = [OperationalError("Lost connection"), None, None]
+        with self.assertRaises(OperationalError):
+            with BraInserter(credentials=self.credentials, asynchronous=True, batch_size=1) as inserter:
+                inserter.insert(StructuredData(original_link="link_0"))
+                with self.assertRaises(OperationalError):
+                    inserter.flush()
+                with self.assertRaises(OperationalError):
+                    inserter.insert(StructuredData(original_link="link_1"))
+                with self.assertRaises(OperationalError):
+                    inserter.flush()
+        self.assertEqual(self._get_cursor().executemany.call_count, 1)
+
+    def test_error_in_block_is_not_hidden(self):
+        """Test that the writer error does not replace an error raised in the with block.
+        """
+        self._get_cursor().executemany.side_effect = OperationalError("Lost connection")
+        with self.assertRaises(KeyError):
+            with BraInserter(credentials=self.credentials, asynchronous=True, batch_size=1) as inserter:
+                inserter.insert(StructuredData(original_link="link_0"))
+                inserter.rows.join()
+                raise KeyError("parser")
+
+    def test_list_inserted_links(self):
+        """Test that the links are looked for by chunks.
+        """
+        with BraInserter(credentials=self.credentials) as inserter:
+            self._get_cursor().fetchall.side_effect = [[{"original_link": "link_1"}], [{"original_link": "link_4"}]]
+            inserted = inserter.list_inserted_links([f"link_{index}" for index in range(5)], chunk_size=3)
+        self.assertEqual(inserted, {"link_1", "link_4"})
+        self.assertEqual(self._get_cursor().execute.call_args_list[-1].args[1], ("link_3", "link_4"))
+
+    def test_summary_upsert(self):
+        """Test that the summary table is upserted from the inserted rows only, before the commit.
+        """
+        cursor = self._get_cursor()
+        with BraInserter(credentials=self.credentials) as inserter:
+            # The batch insert fails on link_1, inserted again row by row
+            cursor.executemany.side_effect = [IntegrityError("Duplicate"), None]
+            cursor.execute.side_effect = [None, IntegrityError("Duplicate"), None]
+            inserter._insert_batch([
+                inserter._get_row(StructuredData(original_link="link_0", massif="beaufortain",
+                                                 date=datetime(2022, 2, 28), risk_score=3)),
+                inserter._get_row(StructuredData(original_link="link_1", massif="beaufortain",
+                                                 date=datetime(2022, 2, 28), risk_score=4)),
+                inserter._get_row(StructuredData(original_link="link_2", massif="beaufortain")),
+            ])
+        query, summaries = cursor.executemany.call_args_list[-1].args
+        self.assertIn("ON DUPLICATE KEY UPDATE", query)
+        self.assertTrue(RE_INSERT_VALUES.match(query))
+        self.assertEqual(summaries, [("beaufortain", date(2022, 2, 28), 3, None, "link_0")])
+
+    def test_summary_without_risk(self):
+        """Test that a bulletin whose risk could not be read is left out of the summary table.
+        """
+        with BraInserter(credentials=self.credentials) as inserter:
+            row = inserter._get_row(StructuredData(original_link="link_0", massif="beaufortain",
+                                                   date=datetime(2022, 2, 28)))
+            self.assertIsNone(inserter._get_summary_row(row))
@@ -0,0 +1,83 @@
+"""Test covering the work queue class.
+"""
+import multiprocessing
+import os
+import unittest
+import uuid
+from unittest import mock
+
+from dotenv import load_dotenv
+
+from bra_database.leases import BraWorkQueue
+from bra_database.utils import DbCredentials, RetryPolicy, is_retryable_db_error
+
+
+def _work(day: str, owner: str, output: multiprocessing.Queue) -> None:
+    """Claim items until the queue is empty.
+    """
+    with BraWorkQueue(credentials=DbCredentials(), owner=owner) as queue:
+        while True:
+            items = queue.claim(day, size=2)
+            if not items:
+                break
+            queue.complete(items)
+            for item in items:
+                output.put(item)
+
+
+class LeasesTests(unittest.TestCase):
+    """Test cases for the work queue class.
+    """
+
+    def setUp(self) -> None:
+        load_dotenv()
+        # A day that can not collide with real data
+        self.day = uuid.uuid4().hex[0:8]
+        self.items = [(f"MASSIF{index}", time) for index in range(10) for time in ["20220228150738", "20220301150738"]]
+
+    @unittest.skipUnless(os.environ.get("MYSQL_HOST"), "Meant to be run locally.")
+    def test_several_workers(self):
+        """Test that several processes split the items without overlap.
+        """
+        with BraWorkQueue(credentials=DbCredentials()) as queue:
+            self.assertEqual(queue.enqueue(self.day, self.items), 20)
+            self.assertEqual(queue.enqueue(self.day, self.items), 0)
+        output = multiprocessing.Queue()
+        workers = [
+            multiprocessing.Process(target=_work, args=(self.day, f"worker-{index}", output)) for index in range(4)
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        items = [output.get() for _ in range(output.qsize())]
+        self.assertEqual(len(items), 20)
+        self.assertEqual(len(set(items)), 20)
+
+    @unittest.skipUnless(os.environ.get("MYSQL_HOST"), "Meant to be run locally.")
+    def test_expired_lease(self):
+        """Test that the items of a crashed worker are claimed again once their lease is over.
+        """
+        with BraWorkQueue(credentials=DbCredentials(), lease_seconds=-1, owner="crashed") as crashed:
+            crashed.enqueue(self.day, self.items[0:2])
+            self.assertEqual(len(crashed.claim(self.day, size=2)), 2)
+        with BraWorkQueue(credentials=DbCredentials(), owner="other") as other:
+            items = other.claim(self.day, size=2)
+            self.assertEqual(len(items), 2)
+            self.assertEqual(other.complete(items), 2)
+            self.assertEqual(other.count_remaining(self.day), 0)
+
+    def test_renew(self):
+        """Test that renewing the leases drops the items whose token was taken over, the database being mocked.
+        """
+        credentials = mock.MagicMock(database="bra", table="france")
+        credentials.retry_policy = RetryPolicy("MySQL", is_retryable=is_retryable_db_error, tries=1)
+        with mock.patch("pymysql.connect") as connect:
+            with BraWorkQueue(credentials=credentials) as queue:
+                queue.tokens = {("A", "1"): "token_a", ("B", "1"): "token_b"}
+                cursor = connect.return_value.cursor.return_value.__enter__.return_value
+                cursor.fetchall.return_value = [("token_b", )]
+                self.assertEqual(queue.renew([("A", "1"), ("B", "1")]), [("B", "1")])
+                self.assertEqual(queue.tokens, {("B", "1"): "token_b"})
+                self.assertIn("SET expires", cursor.execute.call_args_list[-2].args[0])
+                self.assertEqual(cursor.execute.call_args_list[-2].args[1], (600, "token_a", "token_b"))
@@ -0,0 +1,74 @@
+"""Test covering the load test harness.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+
+import cv2
+
+from bra_database.loadtest import ROOT_PATH, DbStandIn, StandInCursor, SyntheticBraServer, run_load_test
+from bra_database.parser import PdfParser
+
+
+class LoadTestTests(unittest.TestCase):
+    """Test cases for the load test harness.
+    """
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self) -> None:
+        shutil.rmtree(self.tmp)
+
+    def test_run_load_test(self):
+        """Test a small offline backfill, without OCR.
+        """
+        report = run_load_test(days=2,
+                               massifs=2,
+                               work_path=self.tmp,
+                               skip_ocr=True,
+                               archive=True,
+                               ocr_cache="daily")
+        self.assertEqual(report.files, 4)
+        self.assertGreater(report.files_per_second, 0)
+        self.assertGreater(report.db_round_trips, 0)
+        self.assertEqual(report.db_rows, 4)
+        self.assertGreater(report.peak_rss_mib, 0)
+        self.assertIn("parse", report.stages)
+        self.assertIn("4 files", report.report())
+        # A new OCR cache every day
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp, "ocr_cache"))),
+                         ["20220101.sqlite", "20220102.sqlite"])
+
+    def test_executemany_round_trips(self):
+        """Test that a multi-row insert is one round-trip only if pymysql can batch its query.
+        """
+        database = DbStandIn()
+        cursor = StandInCursor(database, as_dict=False)
+        cursor.executemany("INSERT INTO bra.france (original_link) VALUES (%s)", [("link_0", ), ("link_1", )])
+        self.assertEqual(database.round_trips, 1)
+        cursor.executemany("INSERT INTO bra.france (original_link) VALUES (LOWER(%s))", [("link_2", ), ("link_3", )])
+        self.assertEqual(database.round_trips, 3)
+
+    def test_synthetic_risk_images(self):
+        """Test that the synthetic PDF files have different risk images, and still parse as the sample.
+        """
+        server = SyntheticBraServer(os.path.join(ROOT_PATH, "tests", "data", "BEAUFORTAIN.20220228150738.pdf"), 5)
+        file_names = {}
+        for day in range(1, 32):
+            for massif in server.massifs:
+                file_names.setdefault(server.get_risk(f"{massif}.202201{day:02d}150738.pdf"),
+                                      f"{massif}.202201{day:02d}150738.pdf")
+        self.assertEqual(sorted(file_names), [1, 2, 3, 4, 5])
+        server.server.server_close()
+        parser = PdfParser(image_output_path=self.tmp)
+        fingerprints = set()
+        for file_name in file_names.values():
+            file_path = os.path.join(self.tmp, f"BRA.{file_name}")
+            with open(file_path, "wb") as pdf:
+                pdf.write(server.get_pdf(file_name))
+            structured_data, image_path = parser._parse(file_path, ocr=False)
+            self.assertEqual(structured_data.massif, "beaufortain")
+            fingerprints.add(parser._get_fingerprint(cv2.imread(image_path)[0:60, 0:60]))    # pylint: disable=E1101
+        self.assertEqual(len(fingerprints), 5)
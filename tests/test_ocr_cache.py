@@ -0,0 +1,87 @@
+"""Test covering the OCR cache class.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import cv2  # type: ignore
+import numpy
+
+from bra_database.ocr_cache import DbRiskOcrCache, RiskOcrCache
+from bra_database.parser import PdfParser
+from bra_database.utils import RetryPolicy, is_retryable_db_error
+
+
+class OcrCacheTests(unittest.TestCase):
+    """Test cases for the OCR cache class.
+    """
+
+    def setUp(self) -> None:
+        self.tmp = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmp, "ocr_cache.sqlite")
+        self.cache = RiskOcrCache(self.cache_path, max_size=2)
+
+    def tearDown(self) -> None:
+        self.cache.close()
+        shutil.rmtree(self.tmp)
+
+    def test_get_and_put(self):
+        """Test that images are found by their digest, only if read with enough confidence, and the counters.
+        """
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 3, 0.8)
+        self.assertEqual(self.cache.get("a").risk, 3)
+        self.assertEqual(self.cache.get("a").confidence, 0.8)
+        # Not trusted, to be read again
+        self.cache.put("b", 4, 0.2)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 2))
+
+    def test_digits_never_match(self):
+        """Test that the crops of different digits never match each other.
+        """
+        self.cache.close()
+        self.cache = RiskOcrCache(self.cache_path)
+        digests = {}
+        for digit in range(1, 6):
+            crop = numpy.full((60, 60, 3), 255, dtype=numpy.uint8)
+            cv2.putText(crop, str(digit), (12, 50), cv2.FONT_HERSHEY_SIMPLEX, 1.6, (0, 0, 0), 4)
+            digests[digit] = PdfParser._get_fingerprint(crop)
+        for digit, digest in digests.items():
+            self.assertIsNone(self.cache.get(digest))
+            self.cache.put(digest, digit, 1.0)
+        for digit, digest in digests.items():
+            self.assertEqual(self.cache.get(digest).risk, digit)
+
+    def test_eviction_and_persistence(self):
+        """Test that the least recently used image is evicted, and that the cache is found back from its file.
+        """
+        self.cache.put("a", 1, 1.0)
+        self.cache.put("b", 2, 1.0)
+        self.cache.get("a")
+        self.cache.put("c", 3, 0.5)
+        self.assertEqual(list(self.cache.entries), ["a", "c"])
+        self.cache.close()
+        self.cache = RiskOcrCache(self.cache_path, max_size=2)
+        self.assertEqual(list(self.cache.entries), ["a", "c"])
+        self.assertEqual(self.cache.get("a").risk, 1)
+        self.assertEqual(self.cache.get("c").confidence, 0.5)
+
+    def test_database_storage(self):
+        """Test that the cache is loaded from and stored in the database, its connection being mocked.
+        """
+        credentials = mock.MagicMock(database="bra", table="france")
+        credentials.retry_policy = RetryPolicy("MySQL", is_retryable=is_retryable_db_error, tries=1)
+        with mock.patch("pymysql.connect") as connect:
+            cursor = connect.return_value.cursor.return_value.__enter__.return_value
+            cursor.fetchall.return_value = [("a", 3, 1.0), ("b", 4, 1.0)]
+            with DbRiskOcrCache(credentials, max_size=2) as cache:
+                self.assertEqual(list(cache.entries), ["a", "b"])
+                self.assertEqual(cache.get("a").risk, 3)
+                cache.put("c", 2, 0.9)
+                queries = [call.args[0] for call in cursor.execute.call_args_list]
+                self.assertIn("REPLACE INTO bra.france_ocr_cache", queries[-2])
+                self.assertEqual(cursor.execute.call_args_list[-1].args[1], ["b"])
+            self.assertEqual(sorted(cursor.execute.call_args_list[-1].args[1][1:]), ["a", "c"])
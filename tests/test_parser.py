@@ -1,9 +1,13 @@
 """Test the parser module.
 """
 import os
+import tempfile
 import unittest
 from datetime import datetime
+from unittest import mock
 
+from bra_database.archive import BraArchive
+from bra_database.ocr_cache import RiskOcrCache
 from bra_database.parser import PdfParser
 
 
@@ -28,3 +32,55 @@ class ParserTests(unittest.TestCase):
         self.assertEqual(structured_data.until, datetime(2022, 3, 1, 0, 0))
         self.assertEqual(structured_data.departs, "rares coulée")
         self.assertEqual(structured_data.declanchements, "quelques plaques en ubacs d'altitudes moyennes")
+
+    def test_get_risk_ints_batch(self):
+        """Test that the OCR runs once per configuration for a whole batch and maps digits back to their image.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            parser = PdfParser(image_output_path=tmp)
+            _, image_path = parser._parse(os.path.join(self.data, "BEAUFORTAIN.20220228150738.pdf"), ocr=False)
+            self.assertTrue(os.path.isfile(image_path))
+            with mock.patch("pytesseract.image_to_string", return_value="3\n\x0c\x0c4\n\x0c") as ocr:
+                risks = parser._get_risk_ints([image_path, image_path, image_path])
+            self.assertEqual(ocr.call_count, 4 * 15)
+            self.assertEqual(risks, [3, None, 4])
+
+    def test_get_risk_ints_cache(self):
+        """Test that an image is analysed once by the OCR, and then read from the cache.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            with RiskOcrCache(os.path.join(tmp, "ocr_cache.sqlite")) as cache:
+                parser = PdfParser(image_output_path=tmp, ocr_cache=cache)
+                _, image_path = parser._parse(os.path.join(self.data, "BEAUFORTAIN.20220228150738.pdf"), ocr=False)
+                with mock.patch("pytesseract.image_to_string", return_value="3\n\x0c") as ocr:
+                    self.assertEqual(parser._get_risk_ints([image_path, image_path]), [3, 3])
+                    self.assertEqual(ocr.call_count, 4 * 15)
+                    self.assertEqual(parser._get_risk_ints([image_path]), [3])
+                    self.assertEqual(ocr.call_count, 4 * 15)
+                self.assertEqual((cache.hits, cache.misses), (1, 1))
+                self.assertEqual([(entry.risk, entry.confidence) for entry in cache.entries.values()], [(3, 1.0)])
+
+    def test_parse_batch_removes_images(self):
+        """Test that the risk images of a batch are deleted once read by the OCR.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            parser = PdfParser(image_output_path=tmp)
+            with mock.patch("pytesseract.image_to_string", return_value="3\n\x0c"):
+                parsed = parser.parse_batch([os.path.join(self.data, "BEAUFORTAIN.20220228150738.pdf")])
+            self.assertEqual(parsed[0].risk_score, 3)
+            self.assertEqual(os.listdir(tmp), [])
+
+    def test_parse_from_archive(self):
+        """Test parsing a PDF file read in memory from the archive.
+        """
+        with tempfile.TemporaryDirectory() as tmp:
+            parser = PdfParser(image_output_path=tmp)
+            file_name = "BEAUFORTAIN.20220228150738.pdf"
+            with BraArchive(os.path.join(tmp, "archive")) as archive:
+                with open(os.path.join(self.data, file_name), "rb") as pdf:
+                    archive.put(f"https://donneespubliques.meteofrance.fr/donnees_libres/Pdf/BRA/BRA.{file_name}",
+                                pdf.read())
+                structured_data, image_path = parser._parse(file_name, ocr=False, archive=archive)
+            self.assertEqual(structured_data.massif, "beaufortain")
+            self.assertEqual(structured_data.date, datetime(2022, 2, 28, 0, 0))
+            self.assertTrue(os.path.isfile(image_path))
@@ -1,5 +1,6 @@
 """Utils-related tests.
 """
+import json
 import logging
 import os
 import shutil
@@ -7,7 +8,10 @@ import tempfile
 import unittest
 from datetime import datetime
 
-from bra_database.utils import get_logger
+from pymysql.err import IntegrityError, OperationalError
+
+from bra_database.utils import (RetryPolicy, StabiliteManteauKeys, get_logger,
+                                is_retryable_db_error)
 
 
 class UtilsTests(unittest.TestCase):
@@ -31,3 +35,77 @@ class UtilsTests(unittest.TestCase):
         logger.info("tests")
         today = datetime.today().strftime("%Y%m%d")
         self.assertIn(f"{today}_bra_database.log", os.listdir(self.tmp))
+
+    def test_get_logger_idempotent(self):
+        """Test that getting the logger several times does not pile up handlers.
+        """
+        logger = get_logger(self.tmp)
+        handlers = list(logger.handlers)
+        self.assertIs(get_logger(self.tmp), logger)
+        self.assertIs(get_logger(), logger)
+        self.assertEqual(logger.handlers, handlers)
+        self.assertEqual(len(handlers), 1)
+
+    def test_get_logger_level(self):
+        """Test that the level is case insensitive, as it can be written in BRA_LOG_LEVEL.
+        """
+        logger = get_logger(self.tmp, level="debug")
+        self.assertEqual(logger.level, logging.DEBUG)
+        get_logger(level="INFO")
+
+    def test_get_logger_json(self):
+        """Test the JSON lines format.
+        """
+        logger = get_logger(self.tmp, file_name="json.log", json_format=True)
+        logger.warning("tests")
+        # Getting another file writes the pending records of the previous one
+        get_logger(self.tmp, file_name="other.log")
+        with open(os.path.join(self.tmp, "json.log"), encoding="utf8") as log_file:
+            record = json.loads(log_file.readline())
+        self.assertEqual(record["message"], "tests")
+        self.assertEqual(record["level"], "WARNING")
+
+    def test_stabilite_manteau_keys(self):
+        """Test the mapping of the stabilite manteau keys, with or without accents.
+        """
+        keys = StabiliteManteauKeys()
+        self.assertEqual(keys.retrieve_best_match("Déclenchements skieurs"), "declanchements_provoques")
+        self.assertEqual(keys.retrieve_best_match("DEPARTS SPONTANES"), "departs_spontanes")
+        self.assertIsNone(keys.retrieve_best_match("qualité"))
+
+    def test_stabilite_manteau_segment(self):
+        """Test that a " : " inside a section text does not create a new key.
+        """
+        text_bloc = ("\nsituation avalancheuse typique : neige ventée\n"
+                     "avalanches spontanées : rares coulées\nqualité : humide\n"
+                     "déclenchements skieurs : plaques à cause : du vent\nen altitude")
+        sections = StabiliteManteauKeys().segment(text_bloc)
+        self.assertEqual(set(sections), {"situation_avalancheuse_typique", "departs_spontanes",
+                                         "declanchements_provoques"})
+        self.assertEqual(sections["departs_spontanes"].title, "avalanches spontanées")
+        self.assertEqual(sections["departs_spontanes"].text, "rares coulées qualité humide")
+        self.assertEqual(sections["declanchements_provoques"].text, "plaques à cause du vent en altitude")
+        self.assertEqual(sections["situation_avalancheuse_typique"].confidence, 1.0)
+
+    def test_retry_policy_db_errors(self):
+        """Test that lost connections are retried, not integrity errors.
+        """
+        calls = []
+
+        def lost_connection_once():
+            calls.append(1)
+            if len(calls) == 1:
+                raise OperationalError(2013, "Lost connection")
+            return "ok"
+
+        policy = RetryPolicy("MySQL", is_retryable=is_retryable_db_error, base_delay=0.01)
+        self.assertEqual(policy.call(lost_connection_once), "ok")
+        self.assertEqual(len(calls), 2)
+
+        def duplicate():
+            calls.append(1)
+            raise IntegrityError(1062, "Duplicate entry")
+
+        with self.assertRaises(IntegrityError):
+            policy.call(duplicate)
+        self.assertEqual(len(calls), 3)